@@ -0,0 +1,201 @@
+"""End-to-end load scenarios against a real broker.
+
+Runs src.broker.Broker in a subprocess on localhost and drives it with raw
+sockets, one scenario at a time. Every subscriber subscribes to every topic,
+and the publisher cycles through the topics. Each scenario changes one of serializer,
+fan-out width, payload size, topic count and idle connection count from a
+baseline, and reports messages delivered per second, p50/p99
+publish-to-deliver latency and the broker RSS. Results are printed, or
+written to --output, as JSON.
+"""
+import argparse
+import json
+import platform
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+from src.broker import Broker, Serializer
+from src.framing import FrameBuffer
+from src.payload import materialize
+
+BASELINE = {"serializer": "JSON", "subscribers": 1, "payload": 64, "topics": 1, "connections": 0}
+VARIATIONS = {
+    "serializer": ["JSON", "XML", "PICKLE", "BINARY"],
+    "subscribers": [1, 10, 100, 1000],
+    "payload": [16, 1024, 16384],
+    "topics": [1, 100],
+    "connections": [0, 1000],
+}
+QUEUES = {"JSON": "JSONQueue", "XML": "XMLQueue", "PICKLE": "PickleQueue", "BINARY": "BinaryQueue"}
+
+codecs = Broker.__new__(Broker)  # encode/decode only, no socket
+codecs.metrics = None
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def start_broker(port: int) -> subprocess.Popen:
+    """Start a broker on port and wait until it accepts connections."""
+    process = subprocess.Popen(
+        [sys.executable, "-c", "from src.broker import Broker; Broker(port=%d).run()" % port],
+        stdout=subprocess.DEVNULL,
+    )
+    while True:
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return process
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+
+
+def rss(pid: int) -> int:
+    """Resident set size of pid in bytes, or None where /proc is missing."""
+    try:
+        with open("/proc/%d/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def connect(port: int, serializer: Serializer) -> socket.socket:
+    conn = socket.create_connection(("localhost", port))
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    ack = json.dumps({"method": "ACK", "Serializer": QUEUES[serializer.name]}).encode("utf-8")
+    conn.sendall(len(ack).to_bytes(3, "little") + ack)
+    return conn
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)] if samples else None
+
+
+class Receiver:
+    """Reads deliveries from every subscriber socket."""
+
+    def __init__(self, serializer: Serializer, conns):
+        self.decode = getattr(codecs, "decode" + serializer.name)
+        self.selector = selectors.DefaultSelector()
+        for conn in conns:
+            conn.setblocking(False)
+            self.selector.register(conn, selectors.EVENT_READ, FrameBuffer())
+
+    def receive(self, count: int, timeout: float):
+        """Wait for count deliveries; returns the latency of each, in seconds."""
+        latencies, deadline = [], time.perf_counter() + timeout
+        while len(latencies) < count and time.perf_counter() < deadline:
+            for key, _ in self.selector.select(timeout=0.1):
+                inbound = key.data
+                try:
+                    inbound.recv_from(key.fileobj)
+                except BlockingIOError:
+                    continue
+                for data in inbound.frames():
+                    message = materialize(self.decode(data)[2])
+                    sent = float(str(message).split("|", 1)[0])
+                    latencies.append(time.perf_counter() - sent)
+        return latencies
+
+
+def run_scenario(port, pid, serializer, subscribers, payload, topics, connections, messages, samples):
+    """Measure one combination of parameters against the broker on port."""
+    serializer = Serializer[serializer]
+    names = ["/bench/%d" % n for n in range(topics)]
+    idle = [connect(port, serializer) for _ in range(connections)]
+
+    subscribed = []
+    for _ in range(subscribers):
+        conn = connect(port, serializer)
+        for name in names:
+            conn.sendall(codecs.encode(serializer, "SUBSCRIBE", name, name))
+        subscribed.append(conn)
+    publisher = connect(port, serializer)
+    receiver = Receiver(serializer, subscribed)
+    time.sleep(0.2)  # let the subscriptions land
+
+    padding = "x" * payload
+
+    def publish(n):
+        message = "%.9f|%s" % (time.perf_counter(), padding)
+        publisher.sendall(codecs.encode(serializer, "PUBLISH", names[n % topics], message))
+        return subscribers
+
+    start = time.perf_counter()
+    expected = sum(publish(n) for n in range(messages))
+    delivered = len(receiver.receive(expected, timeout=60))
+    elapsed = time.perf_counter() - start
+
+    latencies = []
+    for n in range(samples):
+        latencies += receiver.receive(publish(n), timeout=5)
+
+    result = {
+        "delivered": delivered,
+        "expected": expected,
+        "messages_per_second": delivered / elapsed,
+        "p50_latency_us": (percentile(latencies, 0.5) or 0) * 1e6,
+        "p99_latency_us": (percentile(latencies, 0.99) or 0) * 1e6,
+        "broker_rss_bytes": rss(pid),
+    }
+    for conn in idle + subscribed + [publisher]:
+        conn.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", help="messages published per scenario", type=int, default=2000)
+    parser.add_argument("--samples", help="paced publishes timed per scenario", type=int, default=200)
+    parser.add_argument("--output", help="file to write the JSON results to", default=None)
+    args = parser.parse_args()
+
+    # 1000 subscribers plus 1000 idle connections, on both ends
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    scenarios = []
+    for dimension, values in VARIATIONS.items():
+        for value in values:
+            scenario = dict(BASELINE, **{dimension: value})
+            if scenario not in scenarios:
+                scenarios.append(scenario)
+
+    results = []
+    for scenario in scenarios:
+        port = free_port()
+        broker = start_broker(port)
+        try:
+            measured = run_scenario(port, broker.pid, messages=args.messages, samples=args.samples,
+                                    **scenario)
+        finally:
+            broker.terminate()
+            broker.wait()
+        results.append(dict(scenario, **measured))
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    report = json.dumps({
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "messages": args.messages,
+        "samples": args.samples,
+        "results": results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
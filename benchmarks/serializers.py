@@ -0,0 +1,49 @@
+"""Per-message cost of each broker serializer.
+
+Times the broker encoding a message and the client decoding it, for every
+Serializer, and prints the results as JSON.
+"""
+import argparse
+import json
+import timeit
+
+from src.broker import Broker, Serializer
+
+payloads = {
+    "int": 21,
+    "float": 21.5,
+    "str": "Valeu a pena? Tudo vale a pena",
+    "list": list(range(50)),
+}
+
+
+def bench(broker, _format, message, number):
+    """Seconds per encode and per decode of message in _format."""
+    encode = getattr(broker, "encode" + _format.name)
+    decode = getattr(broker, "decode" + _format.name)
+    data = encode("MESSAGE", "/weather2/temperature/celsius", message)
+
+    return {
+        "bytes": len(data),
+        "encode_us": timeit.timeit(
+            lambda: encode("MESSAGE", "/weather2/temperature/celsius", message), number=number
+        ) / number * 1e6,
+        "decode_us": timeit.timeit(lambda: decode(data), number=number) / number * 1e6,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", help="iterations per measurement", type=int, default=20000)
+    args = parser.parse_args()
+
+    broker = Broker.__new__(Broker)  # codecs only, no socket
+    results = {
+        _format.name: {
+            name: bench(broker, _format, message, args.number)
+            for name, message in payloads.items()
+        }
+        for _format in Serializer
+        if _format != Serializer.LOCAL
+    }
+    print(json.dumps(results, indent=2))
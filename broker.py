@@ -1,7 +1,59 @@
 """Call broker."""
+import argparse
 
 from src.broker import Broker
+from src.async_broker import AsyncBroker
+from src.workers import run_workers
+
+engines = {
+    "selectors": Broker,
+    "asyncio": AsyncBroker,
+}
 
 if __name__ == "__main__":
-    broker = Broker()
-    broker.run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--engine",
+        help="event loop driving the broker",
+        choices=list(engines.keys()),
+        default=list(engines.keys())[0],
+    )
+    parser.add_argument(
+        "--workers",
+        help="number of processes sharing the port (selectors engine only)",
+        type=int,
+        default=1,
+    )
+    parser.add_argument("--host", help="address to listen on", default="localhost")
+    parser.add_argument("--port", help="TCP port to listen on", type=int, default=5000)
+    parser.add_argument("--backlog", help="pending connections the kernel queues", type=int, default=100)
+    parser.add_argument("--unix-path", help="listen on this Unix socket instead of TCP", default=None)
+    parser.add_argument(
+        "--data-dir",
+        help="directory where published values are persisted",
+        default=None,
+    )
+    parser.add_argument(
+        "--bridge",
+        help="host:port of a broker at another site to forward publishes to (repeatable)",
+        action="append",
+        default=[],
+    )
+    parser.add_argument("--node-id", help="name of this broker in the cluster", default=None)
+    args = parser.parse_args()
+
+    options = {
+        "host": args.host,
+        "port": args.port,
+        "backlog": args.backlog,
+        "unix_path": args.unix_path,
+        "data_dir": args.data_dir,
+        "node_id": args.node_id,
+        "bridges": [(host, int(port)) for host, port in
+                    (address.rsplit(":", 1) for address in args.bridge)],
+    }
+    if args.workers > 1:
+        run_workers(args.workers, **options)
+    else:
+        broker = engines[args.engine](**options)
+        broker.run()
@@ -0,0 +1,82 @@
+"""Bookkeeping for subscribers that acknowledge what they receive."""
+from collections import deque
+from itertools import takewhile
+from typing import Any, List, Tuple
+
+
+class InFlight:
+    """Messages sent to one subscriber and not acknowledged yet.
+
+    At most window messages are in flight; later ones wait, in order, until
+    acknowledgements make room. Both are kept sorted by offset, also when
+    the messages of a departed group member are handed over, so that an
+    acknowledgement up to an offset covers exactly the older messages.
+    """
+
+    __slots__ = ("window", "messages", "waiting")
+
+    def __init__(self, window: int):
+        self.window = window
+        self.messages = {}      #key: offset / value: [redelivery deadline, topic, value]
+        self.waiting = deque()  #(offset, topic, value) past the window
+
+    def __len__(self):
+        return len(self.messages) + len(self.waiting)
+
+    def admit(self, offset: int, topic: str, value: Any, deadline: float) -> bool:
+        """Track a message; True if it may be sent now, False if it has to wait."""
+        if self.waiting or len(self.messages) >= self.window:
+            index = len(self.waiting)
+            while index and self.waiting[index - 1][0] > offset:
+                index -= 1  # handed over from another member, older than ours
+            self.waiting.insert(index, (offset, topic, value))
+            return False
+        self.track(offset, [deadline, topic, value])
+        return True
+
+    def track(self, offset: int, entry: list):
+        """Put entry in flight, keeping the messages sorted by offset."""
+        newest = next(reversed(self.messages), None)
+        self.messages[offset] = entry
+        if newest is not None and offset < newest:
+            self.messages = dict(sorted(self.messages.items()))
+
+    def ack(self, offset: int) -> bool:
+        """Forget the message with offset."""
+        return self.messages.pop(offset, None) is not None
+
+    def ack_upto(self, offset: int) -> int:
+        """Forget every message up to and including offset. Returns how many."""
+        acked = list(takewhile(lambda key: key <= offset, self.messages))
+        for key in acked:
+            del self.messages[key]
+        return len(acked)
+
+    def pending(self) -> List[Tuple[int, str, Any]]:
+        """Every message not acknowledged yet, in flight or waiting, oldest first."""
+        return [(offset, entry[1], entry[2]) for offset, entry in self.messages.items()] + list(self.waiting)
+
+    def discard(self, offsets: List[int]):
+        """Forget the messages with offsets, in flight or waiting."""
+        offsets = set(offsets)
+        for offset in offsets:
+            self.messages.pop(offset, None)
+        self.waiting = deque(message for message in self.waiting if message[0] not in offsets)
+
+    def release(self, deadline: float) -> List[Tuple[int, str, Any]]:
+        """Move waiting messages into the window while there is room."""
+        released = []
+        while self.waiting and len(self.messages) < self.window:
+            offset, topic, value = self.waiting.popleft()
+            self.track(offset, [deadline, topic, value])
+            released.append((offset, topic, value))
+        return released
+
+    def expired(self, now: float, deadline: float) -> List[Tuple[int, str, Any]]:
+        """Messages not acknowledged in time, rescheduled for deadline."""
+        expired = []
+        for offset, entry in self.messages.items():
+            if entry[0] <= now:
+                entry[0] = deadline
+                expired.append((offset, entry[1], entry[2]))
+        return expired
@@ -0,0 +1,156 @@
+"""asyncio engine for the PubSub Message Broker."""
+import asyncio
+
+from src.broker import Broker, OutboundBuffer, Overflow
+from src.framing import FrameBuffer
+from src.local import LocalConnection
+
+try:
+    import uvloop
+except ImportError:  # optional, the default event loop is used instead
+    uvloop = None
+
+
+class BrokerProtocol(asyncio.BufferedProtocol):
+    """One client connection of an AsyncBroker."""
+
+    def __init__(self, broker):
+        """Bind the connection to broker."""
+        self.broker = broker
+        self.transport = None
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.broker.high_water_mark)
+        self.broker.configure(transport.get_extra_info('socket'))
+        self.broker.outbound_of_userDic[self] = OutboundBuffer()
+        self.broker.inbound_of_userDic[self] = FrameBuffer()
+        print('accepted', self, 'from', transport.get_extra_info('peername'))
+
+    def get_buffer(self, sizehint):
+        return self.broker.inbound_of_userDic[self].get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.broker.inbound_of_userDic[self].advance(nbytes)
+        self.broker.received(self)
+
+    def pause_writing(self):
+        self.paused = True
+        self.broker.congested.add(self)
+
+    def resume_writing(self):
+        self.paused = False
+        self.broker.flush(self)
+        self.broker.decongested(self)
+
+    def connection_lost(self, exc):
+        print('closing', self)
+        self.broker.outbound_of_userDic.pop(self, None)
+        self.broker.inbound_of_userDic.pop(self, None)
+        self.broker.forget(self)
+
+
+class AsyncBroker(Broker):
+    """PubSub Message Broker running on an asyncio event loop.
+
+    Speaks the same protocol and keeps the same topic semantics as Broker;
+    only the transport differs. Connections are BrokerProtocol instances.
+    """
+
+    def listen(self):
+        """The server is created by start(), inside the event loop."""
+        self.server = None
+        self.loop = None
+
+    async def start(self):
+        """Start accepting clients on the running event loop."""
+        if self.unbridged:
+            raise ValueError("dialing bridges needs the selectors engine")
+        loop = self.loop = asyncio.get_running_loop()
+        if self._unix_path is not None:
+            self.server = await loop.create_unix_server(
+                lambda: BrokerProtocol(self), self._unix_path, backlog=self._backlog
+            )
+        else:
+            self.server = await loop.create_server(
+                lambda: BrokerProtocol(self), self._host, self._port, backlog=self._backlog
+            )
+        if self.node_id is None:
+            self.node_id = self._unix_path or '%s:%d' % self.server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        """Serve clients until canceled. Can be awaited from an embedding service."""
+        await self.start()
+        try:
+            while not self.canceled:
+                await asyncio.sleep(min(0.5, self.ack_timeout / 4))
+                if self.inflight_of_userDic:
+                    self.redeliver()
+                if self.store is not None:
+                    self.store.sync()
+        finally:
+            if self.store is not None:
+                self.store.sync()
+            self.server.close()
+            for conn in list(self.outbound_of_userDic):
+                conn.transport.close()
+            await self.server.wait_closed()
+
+    def run(self):
+        """Run until canceled, on uvloop when it is installed."""
+        loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.serve_forever())
+        finally:
+            loop.close()
+
+    def stop_reading(self, conn):
+        conn.transport.pause_reading()
+
+    def start_reading(self, conn):
+        conn.transport.resume_reading()
+
+    def decongested(self, conn):
+        super().decongested(conn)
+        if self.resume_pending:
+            self.loop.call_soon(self.resume_producers)
+
+    def signal_wake(self):
+        self.loop.call_soon_threadsafe(self.serve_local)
+
+    def write(self, conn, frame: bytes):
+        """Hand frame to the transport, holding it back while writing is paused."""
+        if type(conn) is LocalConnection:
+            conn.deliveries.put(frame)
+            return
+        outbound = self.outbound_of_userDic.get(conn)
+        if outbound is None:
+            return
+
+        if not conn.paused and not outbound.frames:
+            conn.transport.write(frame)
+            return
+
+        outbound.append(frame)
+        if outbound.size > self.high_water_mark:
+            if self.overflow == Overflow.DISCONNECT:
+                self.disconnect(conn)
+            else:
+                outbound.drop_oldest(self.high_water_mark)
+
+    def flush(self, conn):
+        """Pass the frames held back while paused on to the transport."""
+        outbound = self.outbound_of_userDic.get(conn)
+        if outbound is None or not outbound.frames:
+            return
+        conn.transport.writelines(outbound.frames)
+        outbound.frames.clear()
+        outbound.size = 0
+
+    def disconnect(self, conn):
+        """Close conn; its state is dropped once the transport reports it lost."""
+        if isinstance(conn, LocalConnection):
+            super().disconnect(conn)
+        elif self.outbound_of_userDic.pop(conn, None) is not None:
+            conn.transport.close()
@@ -0,0 +1,96 @@
+"""Compact binary message layout used by BinaryQueue and the broker.
+
+    +--------+------------+-------------+------+---------+
+    | opcode | topic size | topic utf-8 | type | payload |
+    | 1 byte | 2 bytes LE |             | 1 B  |  rest   |
+    +--------+------------+-------------+------+---------+
+
+The payload runs to the end of the frame, so it needs no length of its own.
+When the high bit of the opcode is set, the topic is instead the 4-byte ID
+the broker registered for it. When the next bit is set, the 8-byte offset
+of the message follows the topic.
+"""
+from typing import Any, Optional, Tuple
+import json
+import struct
+
+METHODS = ['ACK', 'PUBLISH', 'SUBSCRIBE', 'CANCEL', 'LIST', 'MESSAGE', 'LAST_POST', 'FORWARD',
+           'REGISTER', 'REGISTERED', 'BATCH', 'STATS', 'CREDIT', 'INTEREST', 'BRIDGE']
+OPCODES = {method: opcode for opcode, method in enumerate(METHODS)}
+
+HEADER = struct.Struct('<BH')   #opcode, topic size
+ID_HEADER = struct.Struct('<BI')    #opcode | TOPIC_ID, topic ID
+TOPIC_ID = 0x80
+OFFSET = 0x40
+FLAGS = TOPIC_ID | OFFSET
+INT = struct.Struct('<q')
+FLOAT = struct.Struct('<d')
+
+#payload types
+NONE = 0
+BOOL = 1
+INT_TYPE = 2
+FLOAT_TYPE = 3
+STR = 4
+BYTES = 5
+JSON = 6    #lists, dicts and integers too large for 8 bytes
+
+
+def encode(method: str, topic: str, message: Any, offset: int = None) -> bytes:
+    """Pack a message into the binary layout."""
+    opcode = OPCODES[method] if offset is None else OPCODES[method] | OFFSET
+    if isinstance(topic, int):
+        header = ID_HEADER.pack(opcode | TOPIC_ID, topic)
+    else:
+        topic = topic.encode('utf-8')
+        header = HEADER.pack(opcode, len(topic)) + topic
+    if offset is not None:
+        header += INT.pack(offset)
+
+    if message is None:
+        return header + bytes((NONE,))
+    if isinstance(message, bool):
+        return header + bytes((BOOL, message))
+    if isinstance(message, int) and -(1 << 63) <= message < (1 << 63):
+        return header + bytes((INT_TYPE,)) + INT.pack(message)
+    if isinstance(message, float):
+        return header + bytes((FLOAT_TYPE,)) + FLOAT.pack(message)
+    if isinstance(message, str):
+        return header + bytes((STR,)) + message.encode('utf-8')
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        return header + bytes((BYTES,)) + bytes(message)
+    return header + bytes((JSON,)) + json.dumps(message).encode('utf-8')
+
+
+def decode(data) -> Tuple[str, str, Any, Optional[int]]:
+    """Unpack (method, topic, message, offset) from a binary frame."""
+    if data[0] & TOPIC_ID:
+        opcode, topic = ID_HEADER.unpack_from(data)
+        start = ID_HEADER.size
+    else:
+        opcode, size = HEADER.unpack_from(data)
+        start = HEADER.size + size
+        topic = str(data[HEADER.size:start], 'utf-8')
+    offset = None
+    if opcode & OFFSET:
+        offset = INT.unpack_from(data, start)[0]
+        start += INT.size
+    kind = data[start]
+    payload = data[start + 1:]
+
+    if kind == NONE:
+        message = None
+    elif kind == BOOL:
+        message = bool(payload[0])
+    elif kind == INT_TYPE:
+        message = INT.unpack_from(payload)[0]
+    elif kind == FLOAT_TYPE:
+        message = FLOAT.unpack_from(payload)[0]
+    elif kind == STR:
+        message = str(payload, 'utf-8')
+    elif kind == BYTES:
+        message = bytes(payload)
+    else:
+        message = json.loads(str(payload, 'utf-8'))
+
+    return METHODS[opcode & ~FLAGS], topic, message, offset
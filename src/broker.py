@@ -1,12 +1,34 @@
 """Message Broker"""
 from typing import Dict, List, Any, Tuple
+from collections import deque
 import enum
+import errno
+import itertools
+import os
 import socket
 import selectors
+import time
 import json
 import pickle
+import re
 import xml
 import xml.etree.ElementTree as element_tree
+from src import binary
+from src.acks import InFlight
+from src.cluster import SeenMessages, aggregate
+from src.framing import FrameBuffer
+from src.local import LocalConnection
+from src.metrics import Metrics
+from src.payload import Payload, materialize
+from src.retention import RetentionLog, sizeof
+from src.store import SegmentStore
+from src.topics import ConsumerGroup, TopicTrie
+
+# PUBLISH frames as the Queue encoders lay them out, split into topic and msg
+JSON_PUBLISH = re.compile(rb'\{"method": "PUBLISH", "topic": ("(?:[^"\\]|\\.)*"|\d+), "msg": (.*)\}\Z', re.DOTALL)
+XML_PUBLISH = re.compile(rb'<\?xml version="1.0"\?><data method="PUBLISH" (topic|topic_id)="([^"&<]*)">'
+                         rb'<msg>(.*)</msg></data>\Z', re.DOTALL)
+
 
 class Serializer(enum.Enum):
     """Possible message serializers."""
@@ -14,160 +36,912 @@ class Serializer(enum.Enum):
     JSON = 0
     XML = 1
     PICKLE = 2
+    BINARY = 3
+    LOCAL = 4   #in-process clients, handed the objects themselves
+
+
+class Overflow(enum.Enum):
+    """What to do with a connection whose outbound buffer passes the high-water mark."""
+
+    DROP_OLDEST = 0
+    DISCONNECT = 1
+
+
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
+
+class OutboundBuffer:
+    """Frames waiting to be written to one connection."""
+
+    __slots__ = ("frames", "size", "sent", "writing")
+
+    def __init__(self):
+        self.frames = deque()   #encoded frames, oldest first
+        self.size = 0           #bytes still to be written
+        self.sent = 0           #bytes of frames[0] already written
+        self.writing = False    #registered for EVENT_WRITE
+
+    def append(self, frame: bytes):
+        self.frames.append(frame)
+        self.size += len(frame)
+
+    def drop_oldest(self, limit: int):
+        """Drop whole frames until at most limit bytes are pending.
+
+        A frame that is already partially written is kept, so the peer never
+        sees a truncated frame."""
+        keep = self.frames.popleft() if self.sent else None
+        while self.frames and self.size > limit:
+            self.size -= len(self.frames.popleft())
+        if keep is not None:
+            self.frames.appendleft(keep)
+
+    def flush(self, conn: socket.socket) -> bool:
+        """Write as much as conn accepts without blocking. True once empty."""
+        while self.frames:
+            buffers = list(itertools.islice(self.frames, IOV_MAX))
+            if self.sent:
+                buffers[0] = memoryview(buffers[0])[self.sent:]
+            try:
+                written = conn.sendmsg(buffers, [], socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.size -= written
+            short = written < sum(len(buffer) for buffer in buffers)
+
+            written += self.sent
+            while self.frames and written >= len(self.frames[0]):
+                written -= len(self.frames.popleft())
+            self.sent = written
+            if short:
+                return False
+        return True
 
 
 class Broker:
     """Implementation of a PubSub Message Broker."""
 
-    def __init__(self):
-        """Initialize broker."""
+    def __init__(self, host: str = "localhost", port: int = 5000,
+                 high_water_mark: int = 4 * 1024 * 1024, overflow: Overflow = Overflow.DROP_OLDEST,
+                 reuse_port: bool = False, worker_id: int = 0,
+                 retention: int = 1, retention_bytes: int = 1024 * 1024,
+                 data_dir: str = None, fsync_interval: float = 1.0, metrics: bool = True,
+                 backlog: int = 100, nodelay: bool = True, sndbuf: int = None, rcvbuf: int = None,
+                 unix_path: str = None, ack_timeout: float = 5.0,
+                 pause_threshold: int = None, credits: int = 256,
+                 node_id: str = None, bridges: List[Tuple[str, int]] = ()):
+        """Initialize broker.
+
+        Each connection may queue up to high_water_mark bytes of outbound
+        frames; past that, overflow decides between dropping its oldest
+        frames and disconnecting it. reuse_port and worker_id are set for
+        the workers of a multi-process broker (see src.workers). Each topic
+        retains its last retention values, up to retention_bytes, for
+        subscribers to replay. With a data_dir, every value is also written to
+        a SegmentStore there, synced at most every fsync_interval seconds, and
+        topics are restored from it on startup. metrics turns on the
+        counters reported to STATS requests.
+
+        Clients connect to host and port with TCP, or with unix_path to that
+        Unix socket instead. backlog is passed to listen(); nodelay sets
+        TCP_NODELAY on client connections and sndbuf/rcvbuf, when given, the
+        size of their kernel buffers. Messages to subscribers that
+        acknowledge them are sent again when not acknowledged within
+        ack_timeout seconds.
+
+        Once a subscriber has more than pause_threshold bytes (by default
+        half the high_water_mark) waiting, the broker stops reading from
+        the connections publishing to it until it catches up. Clients that
+        ask for CREDIT are granted credits publishes at a time, and are not
+        granted more while paused.
+
+        bridges are the (host, port) of brokers at other sites, which this
+        node, named node_id, connects to and keeps reconnecting to. Bridged
+        brokers tell each other the topics they have subscribers for, and
+        only forward publishes matching those."""
         self.canceled = False
-        self._host = "localhost"
-        self._port = 5000
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind((self._host,self._port))
-        self.socket.listen(100)
-        self.selector = selectors.DefaultSelector()
-        self.selector.register(self.socket, selectors.EVENT_READ, self.accept)
+        self.retention = retention
+        self.retention_bytes = retention_bytes
+        self.offset = 0                 #offset of the next published value
+        self.high_water_mark = high_water_mark
+        self.overflow = overflow
+        self._host = host
+        self._port = port
+        self._reuse_port = reuse_port
+        self._backlog = backlog
+        self._nodelay = nodelay
+        self._sndbuf = sndbuf
+        self._rcvbuf = rcvbuf
+        self._unix_path = unix_path
+        self.worker_id = worker_id
+        self.peers = []                 #connections to the other workers
+        self.clock = 0                  #logical clock ordering replicated values
         #init dicionaries
         self.serializer_of_userDic = {} #key: conn  / value: Serializer  
-        self.topics_by_userDic = {}     #key: topic / value: address and format
         self.messages_of_topicsDic = {} #key: topic / value: value
-        self.subtopics_of_topicDic = {} #key: topic / value: subtopic
-        
+        self.topics = TopicTrie()       #subscriptions by topic segment
+        self.topics_of_userDic = {}     #key: conn  / value: subscribed topics
+        self.targets_of_topicDic = {}   #key: topic / value: delivery list
+        self.outbound_of_userDic = {}   #key: conn  / value: OutboundBuffer
+        self.inbound_of_userDic = {}    #key: conn  / value: FrameBuffer
+        self.version_of_topicDic = {}   #key: topic / value: (clock, worker_id)
+        self.topic_ids = {}             #key: topic / value: registered ID
+        self.topic_names = []           #index: ID  / value: topic
+        self.topic_ids_of_userDic = {}  #key: conn  / value: IDs the client knows
+        self.retention_of_topicDic = {} #key: topic / value: RetentionLog
+        self.offset_users = set()       #conns that get the offset of each message
+        self.inflight_of_userDic = {}   #key: conn  / value: InFlight, for acked subscribers
+        self.ack_timeout = ack_timeout
+        self.redeliver_at = 0.0         #monotonic time of the next redelivery check
+        self.pause_threshold = pause_threshold if pause_threshold is not None else high_water_mark // 2
+        self.credits = credits
+        self.resume_pending = False
+        self.congested = set()          #subscribers over the pause_threshold
+        self.paused = set()             #publishers not read from until congestion clears
+        self.credits_of_userDic = {}    #key: conn  / value: publishes it may still send
+        self.node_id = node_id
+        self.epoch = os.urandom(8).hex()  #new on every start, as offsets may restart too
+        self.bridges = {}               #key: conn  / value: node ID of the broker at the other end
+        self.bridge_addresses = {}      #key: conn  / value: (host, port) it was dialed at
+        self.interest = TopicTrie()     #topics the bridged brokers have subscribers for
+        self.interest_of_bridgeDic = {} #key: conn  / value: topics it asked for
+        self.advertised_of_bridgeDic = {}   #key: conn  / value: topics last told to it
+        self.unbridged = list(bridges)  #(host, port) to connect to
+        self.bridge_retry_at = 0.0
+        self.seen = SeenMessages()
+        self.woken = deque()            #LocalConnections with pending requests
+        self.wake_pending = False
+        self.metrics = Metrics() if metrics else None
+        self.store = None
+        if data_dir is not None:
+            self.store = SegmentStore(data_dir, fsync_interval=fsync_interval)
+            self.restore()
+        self.listen()
+
+    def restore(self):
+        """Load the last value of every topic in the store."""
+        for topic in self.store.topics():
+            offset, value = self.store.last(topic)
+            self.messages_of_topicsDic[topic] = value
+            self.retention_of_topicDic[topic] = RetentionLog(self.retention, self.retention_bytes)
+            self.retention_of_topicDic[topic].append(offset, value, sizeof(value))
+        self.offset = self.store.next_offset
+
+    def listen(self):
+        """Open the listening socket and register it with the selector."""
+        if self._unix_path is not None:
+            if os.path.exists(self._unix_path):
+                os.unlink(self._unix_path)  # left behind by an earlier run
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.bind(self._unix_path)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self._reuse_port:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.socket.bind((self._host,self._port))
+        self.socket.listen(self._backlog)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.socket, selectors.EVENT_READ, self.accept)
+        self.waker, wakeup = socket.socketpair()
+        wakeup.setblocking(False)
+        self.selector.register(wakeup, selectors.EVENT_READ, self.wake_up)
+        if self.node_id is None:
+            self.node_id = self._unix_path or '%s:%d' % self.socket.getsockname()[:2]
+
     def accept(self, sock, mask):
         conn, addr = sock.accept()                                  
         print('accepted', conn, 'from', addr)
-        self.selector.register(conn, selectors.EVENT_READ, self.read)
+        conn.setblocking(False)
+        self.configure(conn)
+        self.selector.register(conn, selectors.EVENT_READ, self.serve)
+        self.outbound_of_userDic[conn] = OutboundBuffer()
+        self.inbound_of_userDic[conn] = FrameBuffer()
 
-        header_aux = conn.recv(3)                        
-        header = int.from_bytes(header_aux, "little")  
-        data = conn.recv(header).decode('UTF-8')
-        
-        if data:
-            if json.loads(data)["Serializer"] == 'JSONQueue':
-                self.serializer_of_userDic[conn] = Serializer.JSON
-            elif json.loads(data)["Serializer"] == 'PickleQueue':
-                self.serializer_of_userDic[conn] = Serializer.PICKLE
-            elif json.loads(data)["Serializer"] == 'XMLQueue':
-                self.serializer_of_userDic[conn] = Serializer.XML
-        else:    
-            print('closing', conn)                          
-            self.selector.unregister(conn)                       
-            conn.close() 
-            
+        # the announcement is usually already here, often with a first request
+        self.read(conn, mask)
+
+    def configure(self, conn):
+        """Apply the socket options of the broker to a client connection."""
+        if self._nodelay and conn.family != socket.AF_UNIX:
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self._sndbuf is not None:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._sndbuf)
+        if self._rcvbuf is not None:
+            conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._rcvbuf)
+
+    def add_peer(self, conn):
+        """Exchange publishes with another worker of the same broker over conn."""
+        conn.setblocking(False)
+        self.selector.register(conn, selectors.EVENT_READ, self.serve)
+        self.outbound_of_userDic[conn] = OutboundBuffer()
+        self.inbound_of_userDic[conn] = FrameBuffer()
+        self.serializer_of_userDic[conn] = Serializer.PICKLE
+        self.peers.append(conn)
+
+    def connect_local(self) -> LocalConnection:
+        """Open a connection for a client running in this process."""
+        conn = LocalConnection(self)
+        self.serializer_of_userDic[conn] = Serializer.LOCAL
+        return conn
+
+    def wake(self, conn):
+        """Called from the client thread when conn has requests waiting."""
+        self.woken.append(conn)
+        if not self.wake_pending:
+            self.wake_pending = True
+            self.signal_wake()
+
+    def signal_wake(self):
+        self.waker.send(b'\0')
+
+    def wake_up(self, sock, mask):
+        try:
+            while sock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        self.serve_local()
+
+    def serve_local(self):
+        """Handle the requests of every woken LocalConnection."""
+        self.wake_pending = False
+        while self.woken:
+            conn = self.woken.popleft()
+            while conn.requests:
+                method, topic, message = conn.requests.popleft()
+                if method == 'CLOSE':
+                    self.disconnect(conn)
+                    break
+                if self.metrics is not None:
+                    self.metrics.frames_in[method] += 1
+                self.dispatch(conn, method, topic, message)
+            else:
+                if conn in self.credits_of_userDic:
+                    self.grant(conn)
+
+    def handshake(self, conn, data):
+        """Register the serializer announced in the first frame of conn."""
+        announced = json.loads(str(data, 'utf-8'))["Serializer"]
+        if announced == 'JSONQueue':
+            self.serializer_of_userDic[conn] = Serializer.JSON
+        elif announced == 'PickleQueue':
+            self.serializer_of_userDic[conn] = Serializer.PICKLE
+        elif announced == 'XMLQueue':
+            self.serializer_of_userDic[conn] = Serializer.XML
+        elif announced == 'BinaryQueue':
+            self.serializer_of_userDic[conn] = Serializer.BINARY
+        elif announced == 'BrokerBridge':
+            self.serializer_of_userDic[conn] = Serializer.PICKLE
+            self.bridges[conn] = None
+            self.advertise()
+        else:
+            self.disconnect(conn)
+
+    def serve(self, conn, mask):
+        """Dispatch readiness events of a client connection."""
+        if mask & selectors.EVENT_WRITE:
+            self.flush(conn)
+        if mask & selectors.EVENT_READ and conn in self.outbound_of_userDic:
+            self.read(conn, mask)
 
     def read(self,conn, mask):
-        """ """
-        header = conn.recv(3)                        
-        header = int.from_bytes(header, "little")  
-        data = conn.recv(header)
-
-        if data:
-            if conn in self.serializer_of_userDic:
-                if self.serializer_of_userDic[conn] == Serializer.JSON:
-                    method, topic, message = self.decodeJSON(data)
-                elif self.serializer_of_userDic[conn] == Serializer.XML:
-                    method, topic, message = self.decodeXML(data)
-                elif self.serializer_of_userDic[conn] == Serializer.PICKLE:
-                    method, topic, message = self.decodePICKLE(data)
-
-                if method == 'PUBLISH':
-                    self.put_topic(topic, message)
-                elif method == 'SUBSCRIBE':
-                    self.subscribe(topic,conn, self.serializer_of_userDic[conn])
-                    if topic in self.messages_of_topicsDic:
-                        self.send_message(conn, 'LAST_POST', topic, self.messages_of_topicsDic[topic])
-                elif method == 'LIST':
-                    self.send_message(conn, 'LIST', topic, self.list_topics())
-                elif method == 'CANCEL':
-                    self.unsubscribe(topic, conn)
+        """Handle every complete frame that arrived on conn."""
+        inbound = self.inbound_of_userDic[conn]
+        try:
+            received = inbound.recv_from(conn)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+
+        if not received:
+            self.disconnect(conn)
+            return
+
+        self.received(conn)
+
+    def received(self, conn):
+        """Handle every complete frame buffered for conn."""
+        for data in self.inbound_of_userDic[conn].frames():
+            if conn not in self.serializer_of_userDic:
+                self.handshake(conn, data)
             else:
-                print('closing', conn)
-                self.unsubscribe(topic, conn)
-                self.selector.unregister(conn)
-                conn.close()
+                self.handle(conn, data)
+            if conn not in self.outbound_of_userDic or conn in self.paused:
+                break   # disconnected or paused while handling
+        else:
+            if conn in self.credits_of_userDic:
+                self.grant(conn)
+
+    def handle(self, conn, data):
+        """Act on one frame received from conn."""
+        if self.metrics is not None:
+            started = time.perf_counter()
+        _format = self.serializer_of_userDic[conn]
+        if _format == Serializer.JSON:
+            method, topic, message = self.decodeJSON(data)
+        elif _format == Serializer.XML:
+            method, topic, message = self.decodeXML(data)
+        elif _format == Serializer.PICKLE:
+            method, topic, message = self.decodePICKLE(data)
+        elif _format == Serializer.BINARY:
+            method, topic, message = self.decodeBINARY(data)
+        if self.metrics is not None:
+            self.metrics.decoded(_format, method, len(data), time.perf_counter() - started)
+
+        self.dispatch(conn, method, topic, message, data)
+
+    def dispatch(self, conn, method, topic, message, data=None):
+        """Act on a request of conn; data is the frame it came in, if any."""
+        _format = self.serializer_of_userDic[conn]
+        sent_topic = topic
+        if isinstance(topic, int):
+            if not 0 <= topic < len(self.topic_names):
+                return  # an ID the broker never handed out
+            topic = self.topic_names[topic]
+
+        if method == 'PUBLISH':
+            source = None if data is None else (_format, sent_topic, data)
+            self.put_topic(topic, message, source=source)
+            self.published(conn, topic, 1)
+        elif method == 'BATCH':
+            for value in message:
+                self.put_topic(topic, value)
+            self.published(conn, topic, len(message))
+        elif method == 'CREDIT':
+            self.credits_of_userDic[conn] = 0
+            self.grant(conn)
+        elif method == 'SUBSCRIBE':
+            options = dict(message) if isinstance(message, dict) else {}
+            group = options.pop('group', None)
+            try:
+                self.subscribe(topic,conn, _format, group, options.pop('balance', None))
+            except ValueError:
+                return  # malformed wildcard or balance
+            window = options.pop('window', None)
+            if window is not None and conn not in self.inflight_of_userDic:
+                self.inflight_of_userDic[conn] = InFlight(int(window))
+                self.offset_users.add(conn)
+            if options:
+                self.offset_users.add(conn)
+                self.replay(conn, topic, options)
+            elif group is None and topic in self.messages_of_topicsDic:
+                self.send_message(conn, 'LAST_POST', topic, self.messages_of_topicsDic[topic])
+        elif method == 'LIST':
+            self.send_message(conn, 'LIST', topic, self.list_topics())
+        elif method == 'STATS' and self.metrics is not None:
+            if message == 'text':
+                stats = self.metrics.render(self)
+            else:
+                stats = self.metrics.snapshot(self)
+            self.send_message(conn, 'STATS', topic, stats)
+        elif method == 'ACK':
+            self.acknowledge(conn, message)
+        elif method == 'CANCEL':
+            self.unsubscribe(topic, conn)
+        elif method == 'REGISTER':
+            self.register(topic, conn)
+        elif method == 'INTEREST' and conn in self.bridges:
+            self.bridges[conn] = message['node']
+            self.learn_interest(conn, message['topics'])
+        elif method == 'BRIDGE' and conn in self.bridges:
+            origin, epoch, origin_offset, via, value = message
+            if self.node_id not in via and self.seen.add((origin, epoch, origin_offset)):
+                self.put_topic(topic, value, bridged=(origin, epoch, origin_offset, via))
+        elif method == 'FORWARD' and conn in self.peers:
+            clock, worker_id, value = message
+            self.put_topic(topic, value, (clock, worker_id))
+
+    def published(self, conn, topic, count):
+        """Charge conn count credits, pausing it if topic feeds a congested subscriber."""
+        remaining = self.credits_of_userDic.get(conn)
+        if remaining is not None:
+            self.credits_of_userDic[conn] = remaining - count
+        if self.congested and conn not in self.peers and type(conn) is not LocalConnection:
+            for address, _ in self.targets_of_topicDic.get(topic, ()):
+                if address in self.congested or type(address) is ConsumerGroup and \
+                        any(member in self.congested for member, _ in address.members):
+                    self.paused.add(conn)
+                    self.stop_reading(conn)
+                    return
+
+    def grant(self, conn):
+        """Top the credits of conn back up once it has used half of them."""
+        remaining = self.credits_of_userDic[conn]
+        if remaining <= self.credits // 2 and conn not in self.paused:
+            self.credits_of_userDic[conn] = self.credits
+            self.send_message(conn, 'CREDIT', '', self.credits - remaining)
+
+    def decongested(self, conn):
+        """conn caught up; the paused publishers are resumed once the current event is handled."""
+        self.congested.discard(conn)
+        if self.paused:
+            self.resume_pending = True
+
+    def resume_producers(self):
+        """Read again from every paused publisher.
+
+        Publishers still feeding a congested subscriber are paused again by
+        the first frame they send."""
+        self.resume_pending = False
+        for producer in list(self.paused):
+            self.paused.discard(producer)
+            if producer in self.inbound_of_userDic:
+                self.start_reading(producer)
+                self.received(producer)
+
+    def stop_reading(self, conn):
+        self.watch(conn)
+
+    def start_reading(self, conn):
+        self.watch(conn)
+
+    def watch(self, conn):
+        """Register conn for reading unless paused, and for writing while frames are pending."""
+        outbound = self.outbound_of_userDic[conn]
+        events = (0 if conn in self.paused else selectors.EVENT_READ) | \
+            (selectors.EVENT_WRITE if outbound.writing else 0)
+        try:
+            registered = self.selector.get_key(conn).events
+        except KeyError:
+            registered = 0
+        if events == registered:
+            return
+        if not events:
+            self.selector.unregister(conn)
+        elif not registered:
+            self.selector.register(conn, events, self.serve)
+        else:
+            self.selector.modify(conn, events, self.serve)
+
+    def disconnect(self, conn):
+        """Drop every subscription of conn and close it."""
+        if isinstance(conn, LocalConnection):
+            self.forget(conn)
+            conn.deliveries.put(None)
+            return
+        known = self.outbound_of_userDic.pop(conn, None) is not None
+        self.inbound_of_userDic.pop(conn, None)
+        try:
+            self.selector.unregister(conn)
+        except (KeyError, ValueError):
+            if not known:
+                return  # never registered or already closed
+        print('closing', conn)
+        self.forget(conn)
+        conn.close()
+
+    def forget(self, conn):
+        """Drop every subscription of conn along with its serializer.
+
+        What conn had not acknowledged of the messages it got as a member of
+        consumer groups goes to the members left."""
+        inflight = self.inflight_of_userDic.pop(conn, None)
+        topics = self.topics_of_userDic.pop(conn, [])
+        groups = self.groups_of(conn, topics) if inflight is not None else []
+        for topic in topics:
+            self.topics.unsubscribe(topic, conn)
+        self.targets_of_topicDic.clear()
+        if groups:
+            self.hand_over(inflight, groups)
+        self.serializer_of_userDic.pop(conn, None)
+        self.topic_ids_of_userDic.pop(conn, None)
+        self.offset_users.discard(conn)
+        self.credits_of_userDic.pop(conn, None)
+        self.paused.discard(conn)
+        if conn in self.congested:
+            self.decongested(conn)
+        if conn in self.peers:
+            self.peers.remove(conn)
+        if conn in self.bridges:
+            del self.bridges[conn]
+            self.advertised_of_bridgeDic.pop(conn, None)
+            self.learn_interest(conn, [])
+            del self.interest_of_bridgeDic[conn]
+            if conn in self.bridge_addresses:
+                self.unbridged.append(self.bridge_addresses.pop(conn))
+        elif self.bridges:
+            self.advertise()
 
     def list_topics(self) -> List[str]:
         """Returns a list of strings containing all topics."""
-        list_topics = []
-        for i in self.subtopics_of_topicDic:
-            list_topics.append(i)
-        return list_topics
+        return list(self.messages_of_topicsDic)
 
     def get_topic(self, topic):
         """Returns the currently stored value in topic."""
         if topic in self.messages_of_topicsDic:
-            return self.messages_of_topicsDic[topic]
+            return materialize(self.messages_of_topicsDic[topic])
         else:
             return None
 
-    def put_topic(self, topic, value):
-        """Store in topic the value."""
-        self.messages_of_topicsDic[topic] = value
+    def put_topic(self, topic, value, version=None, source=None, bridged=None):
+        """Store in topic the value.
+
+        Values published here are replicated to the peer workers. Replicated
+        values carry the (clock, worker_id) version of their origin, and only
+        the newest version becomes the stored value, so every worker ends up
+        with the same last value whatever order the copies arrive in.
+
+        source is the (format, topic, frame) the value was published in;
+        subscribers using that format and topic get the frame as it came
+        instead of a re-encoded one. bridged is the (origin node, its epoch,
+        offset there, nodes passed) of a value forwarded from another site."""
+        replicated = version is not None
+        if not replicated:
+            self.messages_of_topicsDic[topic] = value
+            if self.peers:
+                self.clock += 1
+                version = self.version_of_topicDic[topic] = (self.clock, self.worker_id)
+                self.replicate(topic, value, version)
+        else:
+            self.clock = max(self.clock, version[0])
+            if version > self.version_of_topicDic.get(topic, (0, -1)):
+                self.version_of_topicDic[topic] = version
+                self.messages_of_topicsDic[topic] = value
+
+        offset = self.offset
+        self.offset += 1
+        log = self.retention_of_topicDic.get(topic)
+        if log is None:
+            log = self.retention_of_topicDic[topic] = RetentionLog(self.retention, self.retention_bytes)
+        log.append(offset, value, sizeof(value))
+        if self.store is not None:
+            self.store.append(topic, offset, materialize(value))
+        if self.bridges and not replicated:
+            self.bridge(topic, value, bridged or (self.node_id, self.epoch, offset, []))
+
+        targets = self.targets_of_topicDic.get(topic)
+        if targets is None:
+            targets = self.targets_of_topicDic[topic] = self.resolve_targets(topic)
+
+        frames = {}
+        if source is not None and targets:
+            _format, sent_topic, data = source
+            frames[(_format, sent_topic, None)] = len(data).to_bytes(3, "little") + data
+        for address, _format in targets:
+            if type(address) is ConsumerGroup:
+                if not address.members:
+                    continue    # its last member left, maybe earlier in this fan-out
+                address, _format = address.pick(self.outstanding)
+            self.deliver(address, _format, topic, offset, value, frames)
+
+    def deliver(self, address, _format, topic, offset, value, frames=None):
+        """Send address the value published to topic with offset.
+
+        frames is the cache of encoded frames shared by the subscribers of a publish."""
+        inflight = self.inflight_of_userDic.get(address)
+        if inflight is not None and not inflight.admit(offset, topic, value, time.monotonic() + self.ack_timeout):
+            return  # window full, sent once acknowledgements make room
+        frame_offset = offset if address in self.offset_users else None
+        known = self.topic_ids_of_userDic.get(address)
+        if known is None:
+            self.send_message(address, 'MESSAGE', topic, value, _format, frames, frame_offset)
+            return
+
+        topic_id = self.intern(topic)
+        if topic_id not in known:
+            known.add(topic_id)
+            self.send_message(address, 'REGISTERED', topic, topic_id, _format)
+        self.send_message(address, 'MESSAGE', topic_id, value, _format, frames, frame_offset)
+
+    def replay(self, conn, topic, options):
+        """Send conn the retained values of topic as LAST_POST.
+
+        options holds either the 'offset' to replay from or how many of the
+        'last' values to send (by default only the latest). Offsets are
+        replayed from the store when there is one; its records go out to
+        BinaryQueue clients as they are."""
+        if self.store is not None and 'offset' in options:
+            binary_format = self.serializer_of_userDic[conn] == Serializer.BINARY
+            for offset, frame in self.store.since(topic, int(options['offset'])):
+                if binary_format:
+                    self.write(conn, frame)
+                else:
+                    _, _, value, _ = binary.decode(frame[3:])
+                    self.send_message(conn, 'LAST_POST', topic, value, offset=offset)
+            return
+
+        log = self.retention_of_topicDic.get(topic)
+        if log is None:
+            return
+        if 'offset' in options:
+            entries = log.since(int(options['offset']))
+        else:
+            entries = log.last(int(options.get('last', 1)))
+        for offset, value in entries:
+            self.send_message(conn, 'LAST_POST', topic, value, offset=offset)
+
+    def intern(self, topic) -> int:
+        """Returns the ID of topic, registering it on first use.
+
+        Frames that carry the ID resolve to the interned topic string, whose
+        hash is already cached for the dictionary lookups that follow."""
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            topic_id = self.topic_ids[topic] = len(self.topic_names)
+            self.topic_names.append(topic)
+        return topic_id
+
+    def register(self, topic, conn):
+        """Send conn the ID of topic; conn then gets IDs in place of topics."""
+        topic_id = self.intern(topic)
+        self.topic_ids_of_userDic.setdefault(conn, set()).add(topic_id)
+        self.send_message(conn, 'REGISTERED', topic, topic_id)
+
+    def connect_bridges(self):
+        """Start dialing the bridged brokers not connected yet; failures are retried later.
+
+        Connections complete in bridge_connected(), so an unreachable site
+        never holds up the selector loop."""
+        self.bridge_retry_at = time.monotonic() + 1.0
+        for address in list(self.unbridged):
+            try:
+                family, _, _, _, sockaddr = socket.getaddrinfo(*address, type=socket.SOCK_STREAM)[0]
+            except OSError:
+                continue
+            conn = socket.socket(family, socket.SOCK_STREAM)
+            conn.setblocking(False)
+            if conn.connect_ex(sockaddr) not in (0, errno.EINPROGRESS):
+                conn.close()
+                continue
+            self.unbridged.remove(address)
+            self.bridge_addresses[conn] = address
+            self.selector.register(conn, selectors.EVENT_WRITE, self.bridge_connected)
+
+    def bridge_connected(self, conn, mask):
+        """A connection started by connect_bridges() is up, or failed."""
+        self.selector.unregister(conn)
+        if conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+            self.unbridged.append(self.bridge_addresses.pop(conn))
+            conn.close()
+            return
+        self.add_peer(conn)
+        self.peers.remove(conn)     # a bridge, not a worker
+        self.bridges[conn] = None
+        hello = json.dumps({"method": "ACK", "Serializer": "BrokerBridge"}).encode('utf-8')
+        self.write(conn, len(hello).to_bytes(3, "little") + hello)
+        self.advertise()
+
+    def learn_interest(self, conn, topics):
+        """Replace the topics conn asked for, and pass the change on to the other bridges."""
+        for topic in self.interest_of_bridgeDic.get(conn, ()):
+            self.interest.unsubscribe(topic, conn)
+        for topic in topics:
+            self.interest.subscribe(topic, conn)
+        self.interest_of_bridgeDic[conn] = topics
+        self.advertise()
+
+    def advertise(self):
+        """Tell every bridge the topics this side wants, if they changed.
+
+        That is what local clients subscribe to plus what the other bridges
+        asked for, so interest travels along chains of brokers."""
+        if not self.bridges:
+            return
+        local = [topic for conn, topics in self.topics_of_userDic.items()
+                 if conn not in self.bridges for topic in topics]
+        for conn in self.bridges:
+            topics = aggregate(local + [topic for other, asked in self.interest_of_bridgeDic.items()
+                                        if other is not conn for topic in asked])
+            if topics != self.advertised_of_bridgeDic.get(conn):
+                self.advertised_of_bridgeDic[conn] = topics
+                self.send_message(conn, 'INTEREST', '', {'node': self.node_id, 'topics': topics})
+
+    def bridge(self, topic, value, bridged):
+        """Forward a value to the bridges that asked for topic and have not seen it."""
+        origin, epoch, origin_offset, via = bridged
+        via = via + [self.node_id]
+        frame = None
+        for node in self.interest.matches(topic):
+            for conn, _ in node.subscribers:
+                if self.bridges.get(conn) in via:
+                    continue
+                if frame is None:
+                    frame = self.encode(Serializer.PICKLE, 'BRIDGE', topic,
+                                        [origin, epoch, origin_offset, via, materialize(value)])
+                self.write(conn, frame)
+
+    def replicate(self, topic, value, version):
+        """Forward a locally published value to every peer worker."""
+        frame = self.encode(Serializer.PICKLE, 'FORWARD', topic, [version[0], version[1], materialize(value)])
+        for peer in self.peers:
+            self.write(peer, frame)
 
-        if topic not in self.subtopics_of_topicDic:
-            for sub_topic in self.subtopics_of_topicDic:
-                if sub_topic in topic:
-                    self.subtopics_of_topicDic[sub_topic].append(topic)
+    def resolve_targets(self, topic) -> List[Tuple[socket.socket, Serializer]]:
+        """Every (address, format) subscribed to topic or to one of its ancestors.
 
-            self.subtopics_of_topicDic[topic] = []
-            for sub_topic in self.subtopics_of_topicDic:
-                if topic in sub_topic:
-                    self.subtopics_of_topicDic[topic].append(sub_topic)
+        A client subscribed to several matching topics is delivered only once.
+        Consumer groups appear as (ConsumerGroup, None), a member being picked
+        for each message."""
+        targets = {}
+        for node in self.topics.matches(topic):
+            for address, _format in node.subscribers:
+                targets.setdefault(address, _format)
+            for group in node.groups.values():
+                targets.setdefault(group, None)
+        return list(targets.items())
 
-        for i in self.subtopics_of_topicDic[topic]:
-            if i in self.topics_by_userDic and self.topics_by_userDic[i] != []:
-                address = self.topics_by_userDic[i][0][0]
-                self.send_message(address, 'MESSAGE', topic, value)
+    def outstanding(self, conn) -> int:
+        """Frames queued for conn that it has not been sent yet."""
+        outbound = self.outbound_of_userDic.get(conn)
+        queued = len(outbound.frames) if outbound is not None else 0
+        inflight = self.inflight_of_userDic.get(conn)
+        return queued + len(inflight) if inflight is not None else queued
 
+    def acknowledge(self, conn, message):
+        """Handle an ACK of conn: an offset, or {'upto': offset} for all up to it.
+
+        Messages waiting for room in the window are sent as it frees up."""
+        inflight = self.inflight_of_userDic.get(conn)
+        if inflight is None:
+            return
+        if isinstance(message, dict):
+            inflight.ack_upto(int(message['upto']))
+        else:
+            inflight.ack(int(message))
+        for offset, topic, value in inflight.release(time.monotonic() + self.ack_timeout):
+            self.send_message(conn, 'MESSAGE', topic, value, offset=offset)
+
+    def redeliver(self):
+        """Send again the messages whose acknowledgement is overdue."""
+        now = time.monotonic()
+        self.redeliver_at = now + self.ack_timeout / 4
+        for conn, inflight in list(self.inflight_of_userDic.items()):
+            for offset, topic, value in inflight.expired(now, now + self.ack_timeout):
+                if conn not in self.inflight_of_userDic:
+                    break   # disconnected while sending
+                self.send_message(conn, 'MESSAGE', topic, value, offset=offset)
 
     def list_subscriptions(self, topic: str) -> List[socket.socket]:
         """Provide list of subscribers to a given topic."""
-        for i in self.topics_by_userDic:
-            if i==topic:
-                return self.topics_by_userDic[i]
-
-    def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None):
-        """Subscribe to topic by client in address."""
-        if topic not in self.topics_by_userDic:
-            self.topics_by_userDic[topic] = [(address, _format)]
-        else:
-            self.topics_by_userDic[topic].append((address, _format  ))
-   
-        if topic not in self.subtopics_of_topicDic:
-            for sub_topic in self.subtopics_of_topicDic:
-                if sub_topic in topic:
-                    self.subtopics_of_topicDic[sub_topic].append(topic)
-
-            self.subtopics_of_topicDic[topic] = []
-            for sub_topic in self.subtopics_of_topicDic:
-                if topic in sub_topic:
-                    self.subtopics_of_topicDic[topic].append(sub_topic)
+        return self.topics.subscribers(topic)
+
+    def subscribe(self, topic: str, address: socket.socket, _format: Serializer = None,
+                  group: str = None, balance: str = None):
+        """Subscribe to topic by client in address.
+
+        A '+' segment of topic matches any one segment, and a final '#'
+        any number of them. Members of a group share the messages of topic,
+        spread round-robin or, with balance 'least_outstanding', to the
+        member with the fewest frames still queued."""
+        self.topics.subscribe(topic, address, _format, group, balance)
+        self.topics_of_userDic.setdefault(address, []).append(topic)
+        self.targets_of_topicDic.clear()
+        self.advertise()
 
     def unsubscribe(self, topic, address):
-        """Unsubscribe to topic by client in address."""
-        if topic in self.topics_by_userDic:
-            list_users = self.topics_by_userDic[topic]
-            for i in list_users:
-                if i[0] == address:
-                    self.topics_by_userDic[topic].remove(i)
+        """Unsubscribe to topic by client in address.
+
+        Leaving a consumer group hands what address has not acknowledged of
+        its messages over to the other members."""
+        inflight = self.inflight_of_userDic.get(address)
+        groups = self.groups_of(address, [topic]) if inflight is not None else []
+        if self.topics.unsubscribe(topic, address):
+            self.topics_of_userDic[address].remove(topic)
+            self.targets_of_topicDic.clear()
+            self.advertise()
+            if groups:
+                inflight.discard(self.hand_over(inflight, groups))
+                for offset, message_topic, value in inflight.release(time.monotonic() + self.ack_timeout):
+                    self.send_message(address, 'MESSAGE', message_topic, value, offset=offset)
+
+    def groups_of(self, address, topics) -> List[ConsumerGroup]:
+        """The consumer groups address is a member of through its subscriptions to topics."""
+        groups = []
+        for topic in topics:
+            node = self.topics.find(topic)
+            if node is not None:
+                groups += [group for group in node.groups.values()
+                           if any(member is address for member, _ in group.members)]
+        return groups
+
+    def hand_over(self, inflight, groups) -> List[int]:
+        """Deliver the messages of inflight published to groups to the members they have left.
+
+        Returns the offsets of the messages handed over."""
+        moved = []
+        for offset, topic, value in inflight.pending():
+            targets = self.targets_of_topicDic.get(topic)
+            if targets is None:
+                targets = self.targets_of_topicDic[topic] = self.resolve_targets(topic)
+            for group in groups:
+                if group.members and (group, None) in targets:
+                    address, _format = group.pick(self.outstanding)
+                    self.deliver(address, _format, topic, offset, value)
+                    moved.append(offset)
                     break
+        return moved
+
+    def send_message(self,conn, method, topic, message, _format=None, frames=None, offset=None):
+        """Sends a message to conn, encoded with _format or the format it announced.
+
+        frames caches encoded frames by format, topic and offset, so a message
+        sent to many connections is encoded at most once per variant."""
+        if _format is None:
+            _format = self.serializer_of_userDic[conn]
+
+        if frames is None:
+            frame = self.encode(_format, method, topic, message, offset)
+        else:
+            key = (_format, topic, offset)
+            frame = frames.get(key)
+            if frame is None:
+                frame = frames[key] = self.encode(_format, method, topic, message, offset)
+
+        if self.metrics is not None:
+            self.metrics.sent(_format, method, len(frame) if _format != Serializer.LOCAL else 0)
+        self.write(conn, frame)
 
-    def send_message(self,conn, method, topic, message):
-        """"""
-        if self.serializer_of_userDic[conn] == Serializer.JSON:
-            message = self.encodeJSON(method, topic, message) 
-        elif self.serializer_of_userDic[conn] == Serializer.PICKLE:
-            message = self.encodePICKLE(method, topic, message) 
-        elif self.serializer_of_userDic[conn] == Serializer.XML:
-            message = self.encodeXML(method, topic, message) 
+    def write(self, conn, frame: bytes):
+        """Queue frame for conn and write it right away if nothing is pending."""
+        if type(conn) is LocalConnection:
+            conn.deliveries.put(frame)
+            return
+        outbound = self.outbound_of_userDic.get(conn)
+        if outbound is None:
+            return  # disconnected, maybe earlier in the same fan-out
+
+        outbound.append(frame)
+        if len(outbound.frames) == 1:
+            self.flush(conn)
+            return
+        if outbound.size > self.pause_threshold:
+            self.congested.add(conn)
+        if outbound.size > self.high_water_mark:
+            if self.overflow == Overflow.DISCONNECT:
+                self.disconnect(conn)
+            else:
+                outbound.drop_oldest(self.high_water_mark)
+
+    def flush(self, conn):
+        """Write pending frames of conn, watching EVENT_WRITE only while some remain."""
+        outbound = self.outbound_of_userDic.get(conn)
+        if outbound is None:
+            return
+        try:
+            done = outbound.flush(conn)
+        except OSError:
+            self.disconnect(conn)
+            return
+
+        if done != (not outbound.writing):
+            outbound.writing = not done
+            self.watch(conn)
+        if conn in self.congested and outbound.size <= self.pause_threshold // 2:
+            self.decongested(conn)
+
+    def encode(self, _format, method, topic, message, offset=None) -> bytes:
+        """Returns the header and payload of a message in the given format.
+
+        For LOCAL, this is the tuple an in-process client receives. A Payload
+        in another format than _format is decoded first."""
+        if type(message) is Payload and message.format is not _format:
+            message = message.value
+        if _format == Serializer.LOCAL:
+            return method, topic, message, offset
+        if self.metrics is not None:
+            started = time.perf_counter()
+        if _format == Serializer.JSON:
+            message = self.encodeJSON(method, topic, message, offset) 
+        elif _format == Serializer.PICKLE:
+            message = self.encodePICKLE(method, topic, message, offset) 
+        elif _format == Serializer.XML:
+            message = self.encodeXML(method, topic, message, offset) 
+        elif _format == Serializer.BINARY:
+            message = self.encodeBINARY(method, topic, message, offset)
         
         header = len(message).to_bytes(3, "little")   
-        conn.send(header + message)
+        if self.metrics is not None:
+            self.metrics.encoded(_format, time.perf_counter() - started)
+        return header + message
 
     def decodeJSON(self, data):
-        data = data.decode('utf-8')
+        publish = JSON_PUBLISH.match(data)
+        if publish is not None:
+            topic, raw = publish.groups()
+            return 'PUBLISH', json.loads(topic), Payload(Serializer.JSON, raw, self.decodeJSONText)
+        data = str(data, 'utf-8')
         message = json.loads(data)
         method = message['method']
         topic = message['topic']
@@ -175,32 +949,74 @@ class Broker:
         
         return method, topic, message 
 
-    def encodeJSON(self, method, topic, message):
+    def decodeJSONText(self, raw):
+        """The value of the msg key whose JSON is raw.
+
+        raw runs to the end of the frame, so it also holds any keys after msg."""
+        try:
+            return json.loads(raw)
+        except ValueError:
+            return json.loads(b'{"msg": ' + raw + b'}')['msg']
+
+    def encodeJSON(self, method, topic, message, offset=None):
+        if type(message) is Payload:
+            header = json.dumps({'method': method, 'topic': topic})[:-1] + ', "msg": '
+            tail = b'}' if offset is None else b', "offset": %d}' % offset
+            return header.encode('utf-8') + message.raw + tail
         msg_JSON = {'method': method, 'topic': topic, 'msg': message}
+        if offset is not None:
+            msg_JSON['offset'] = offset
         msg_JSON = json.dumps(msg_JSON)
         msg_JSON = msg_JSON.encode('utf-8')
         
         return msg_JSON   
 
-    def encodeXML(self, method, topic, msg):
-        msg_XML = {'method': method, 'topic': topic, 'msg': msg}
-        msg_XML = ('<?xml version="1.0"?><data method="%(method)s" topic="%(topic)s"><msg>%(msg)s</msg></data>' % msg_XML)
+    def encodeXML(self, method, topic, msg, offset=None):
+        if type(msg) is Payload:
+            msg = str(msg.raw, 'utf-8')
+        msg_XML = {'method': method, 'topic': topic, 'msg': msg,
+                   'topic_attr': 'topic_id' if isinstance(topic, int) else 'topic',
+                   'offset': '' if offset is None else ' offset="%d"' % offset}
+        msg_XML = ('<?xml version="1.0"?><data method="%(method)s" %(topic_attr)s="%(topic)s"%(offset)s><msg>%(msg)s</msg></data>' % msg_XML)
         msg_XML = msg_XML.encode('utf-8')
         
         return msg_XML
 
     def decodeXML(self, data):
-        data = data.decode('utf-8')
+        publish = XML_PUBLISH.match(data)
+        if publish is not None:
+            attribute, topic, raw = publish.groups()
+            topic = int(topic) if attribute == b'topic_id' else str(topic, 'utf-8')
+            return 'PUBLISH', topic, Payload(Serializer.XML, raw, self.decodeXMLText)
+        data = str(data, 'utf-8')
         data = element_tree.fromstring(data)
         data_aux = data.attrib
         method = data_aux['method']
-        topic= data_aux['topic']
-        message = data.find('msg').text
+        topic = int(data_aux['topic_id']) if 'topic_id' in data_aux else data_aux['topic']
+        if method == 'BATCH':
+            message = [value.text for value in data.findall('msg')]
+        else:
+            element = data.find('msg')
+            if method == 'SUBSCRIBE' and element.attrib:
+                message = dict(element.attrib)   # the subscribe options
+            else:
+                message = element.text
 
         return method, topic, message
 
-    def encodePICKLE(self,method, topic ,message):
+    def decodeXMLText(self, raw):
+        """The text of the <msg> element whose content is raw.
+
+        raw runs to the last </msg>, so it also holds any elements after the first."""
+        try:
+            return element_tree.fromstring(b'<msg>' + raw + b'</msg>').text
+        except element_tree.ParseError:
+            return element_tree.fromstring(b'<data><msg>' + raw + b'</msg></data>').find('msg').text
+
+    def encodePICKLE(self,method, topic ,message, offset=None):
         msg_PICKLE = {'method': method, 'topic': topic, 'msg': message}
+        if offset is not None:
+            msg_PICKLE['offset'] = offset
         msg_PICKLE = pickle.dumps(msg_PICKLE)
     
         return msg_PICKLE
@@ -213,10 +1029,31 @@ class Broker:
         
         return method, topic, message
 
+    def encodeBINARY(self, method, topic, message, offset=None):
+        return binary.encode(method, topic, message, offset)
+
+    def decodeBINARY(self, data):
+        method, topic, message, _ = binary.decode(data)
+        return method, topic, message
+
     def run(self):
         """Run until canceled."""
         while not self.canceled:
-            events = self.selector.select()
+            events = self.selector.select(timeout=0.5)
+            if self.metrics is not None:
+                started = time.perf_counter()
             for key, mask in events:
                 callback = key.data
-                callback(key.fileobj, mask)
\ No newline at end of file
+                callback(key.fileobj, mask)
+            if self.resume_pending:
+                self.resume_producers()
+            if self.metrics is not None and events:
+                self.metrics.loop_time.record(time.perf_counter() - started)
+            if not events and self.store is not None:
+                self.store.sync()
+            if self.inflight_of_userDic and time.monotonic() >= self.redeliver_at:
+                self.redeliver()
+            if self.unbridged and time.monotonic() >= self.bridge_retry_at:
+                self.connect_bridges()
+        if self.store is not None:
+            self.store.sync()
\ No newline at end of file
@@ -5,10 +5,10 @@ from src.middleware import PickleQueue, MiddlewareType
 class Consumer:
     """Consumer implementation"""
 
-    def __init__(self, topic, queue_type=PickleQueue):
+    def __init__(self, topic, queue_type=PickleQueue, **options):
         """Initialize Queue"""
         self.topic = topic
-        self.queue = queue_type(f"{topic}", _type=MiddlewareType.CONSUMER)
+        self.queue = queue_type(f"{topic}", _type=MiddlewareType.CONSUMER, **options)
         self.received = []
 
     def run(self, events=10):
@@ -21,23 +21,18 @@ class Consumer:
 class Producer:
     """Producer implementation"""
 
-    def __init__(self, topic, value_generator, queue_type=PickleQueue):
-        """Initialize Queue."""
+    def __init__(self, topic, value_generator, queue_type=PickleQueue, **options):
+        """Initialize Queue, a single connection for every topic."""
 
-        if isinstance(topic, list):
-            self.queue = [
-                queue_type(subtopic, _type=MiddlewareType.PRODUCER)
-                for subtopic in topic
-            ]
-        else:
-            self.queue = [queue_type(topic, _type=MiddlewareType.PRODUCER)]
+        self.topics = topic if isinstance(topic, list) else [topic]
+        self.queue = queue_type(self.topics[0], _type=MiddlewareType.PRODUCER, **options)
         self.produced = []
         self.gen = value_generator
 
     def run(self, events=10):
         """Produce at most <events> events."""
         for _ in range(events):
-            for queue, value in zip(self.queue, self.gen()):
-                queue.push(value)
+            for topic, value in zip(self.topics, self.gen()):
+                self.queue.push(value, topic)
 
                 self.produced.append(value)
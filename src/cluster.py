@@ -0,0 +1,41 @@
+"""Helpers for bridging brokers into a cluster."""
+from collections import deque
+from typing import Iterable, List
+
+from src.topics import SEPARATOR
+
+
+def aggregate(topics: Iterable[str]) -> List[str]:
+    """The topics not already covered by a shorter one, sorted.
+
+    Subscribing to a topic covers every topic below it, so '/a' alone stands
+    for '/a', '/a/b' and '/a/b/c'."""
+    kept = []
+    for topic in sorted(set(topics)):
+        if kept and (topic == kept[-1] or topic.startswith(kept[-1] + SEPARATOR)):
+            continue
+        kept.append(topic)
+    return kept
+
+
+class SeenMessages:
+    """The last capacity (origin, epoch, offset) keys bridged in, to drop
+    copies arriving over a second path. The epoch tells a restarted origin,
+    whose offsets may start over, from its previous run."""
+
+    __slots__ = ("capacity", "order", "keys")
+
+    def __init__(self, capacity: int = 4096):
+        self.capacity = capacity
+        self.order = deque()
+        self.keys = set()
+
+    def add(self, key) -> bool:
+        """Remember key; False if it was already there."""
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        self.order.append(key)
+        if len(self.order) > self.capacity:
+            self.keys.discard(self.order.popleft())
+        return True
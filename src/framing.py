@@ -0,0 +1,74 @@
+"""Incremental decoding of length-prefixed frames."""
+from typing import Iterator, Optional
+import socket
+
+HEADER_SIZE = 3     #little-endian payload length
+MIN_READ = 4096     #least free space offered to a single recv
+
+
+class FrameBuffer:
+    """Per-connection receive buffer yielding every complete frame.
+
+    Whatever recv_into returns is appended to one bytearray and frames are
+    handed out as memoryview slices of it, so they are not copied. A frame is
+    only valid until the next read into the buffer.
+    """
+
+    def __init__(self, size: int = 16 * 1024):
+        """Create an empty buffer of size bytes; it grows for larger frames."""
+        self.buffer = bytearray(size)
+        self.start = 0      #first byte not yet handed out
+        self.end = 0        #end of received data
+        self.pending = HEADER_SIZE  #bytes needed to complete the next frame
+
+    def get_buffer(self) -> memoryview:
+        """Free space at the end of the buffer, compacting or growing it first."""
+        used = self.end - self.start
+        if used == 0:
+            self.start = self.end = 0
+
+        need = max(self.pending, used + MIN_READ)
+        if self.start + need > len(self.buffer):
+            if need > len(self.buffer):
+                buffer = bytearray(max(need, 2 * len(self.buffer)))
+                buffer[:used] = self.buffer[self.start:self.end]
+                self.buffer = buffer
+            else:
+                self.buffer[:used] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, used
+
+        return memoryview(self.buffer)[self.end:]
+
+    def advance(self, nbytes: int):
+        """Account for nbytes written into get_buffer()."""
+        self.end += nbytes
+
+    def recv_from(self, sock: socket.socket) -> int:
+        """Receive whatever sock has into the buffer. Returns 0 on EOF."""
+        nbytes = sock.recv_into(self.get_buffer())
+        self.advance(nbytes)
+        return nbytes
+
+    def next_frame(self) -> Optional[memoryview]:
+        """Returns the payload of the next complete frame, or None."""
+        available = self.end - self.start
+        if available < HEADER_SIZE:
+            self.pending = HEADER_SIZE
+            return None
+
+        length = int.from_bytes(self.buffer[self.start:self.start + HEADER_SIZE], "little")
+        if available < HEADER_SIZE + length:
+            self.pending = HEADER_SIZE + length
+            return None
+
+        begin = self.start + HEADER_SIZE
+        self.start = begin + length
+        self.pending = HEADER_SIZE
+        return memoryview(self.buffer)[begin:self.start]
+
+    def frames(self) -> Iterator[memoryview]:
+        """Yield every complete frame currently buffered."""
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
@@ -0,0 +1,29 @@
+"""In-process connections between a Broker and clients in the same process."""
+from collections import deque
+from queue import SimpleQueue
+
+
+class LocalConnection:
+    """Stands in for the socket of a client running inside the broker's process.
+
+    Requests are (method, topic, message) tuples handed to the broker thread,
+    and deliveries are the (method, topic, message, offset) tuples a client
+    would have decoded, so no value is ever serialized or copied. None is
+    delivered once the connection is closed.
+    """
+
+    __slots__ = ("broker", "requests", "deliveries")
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.requests = deque()             #waiting for the broker thread
+        self.deliveries = SimpleQueue()     #waiting for the client
+
+    def send(self, method, topic, message):
+        """Hand a request to the broker."""
+        self.requests.append((method, topic, message))
+        self.broker.wake(self)
+
+    def close(self):
+        """Drop the subscriptions of this connection."""
+        self.send('CLOSE', None, None)
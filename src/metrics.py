@@ -0,0 +1,103 @@
+"""Counters and histograms kept by the broker on its hot path."""
+from collections import Counter
+from typing import Any, Dict
+
+
+class Histogram:
+    """Durations counted in power-of-two microsecond buckets."""
+
+    __slots__ = ("buckets", "count", "total")
+
+    def __init__(self):
+        self.buckets = [0] * 32   #index: bit length of the duration in us
+        self.count = 0
+        self.total = 0.0            #seconds
+
+    def record(self, seconds: float):
+        self.buckets[min(int(seconds * 1e6).bit_length(), 31)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, fraction: float) -> float:
+        """Upper bound, in seconds, of the bucket holding the fraction quantile."""
+        rank, seen = fraction * self.count, 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return (1 << index) / 1e6
+        return 0.0
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "mean_us": self.total / self.count * 1e6 if self.count else 0.0,
+            "p50_us": self.quantile(0.5) * 1e6,
+            "p99_us": self.quantile(0.99) * 1e6,
+        }
+
+
+class Metrics:
+    """Everything the broker counts, reported by snapshot() and render()."""
+
+    def __init__(self):
+        self.frames_in = Counter()  #key: method     / value: frames received
+        self.frames_out = Counter() #key: method     / value: frames queued
+        self.bytes_in = Counter()   #key: serializer / value: bytes received
+        self.bytes_out = Counter()  #key: serializer / value: bytes queued
+        self.decode_time = {}       #key: serializer / value: Histogram
+        self.encode_time = {}       #key: serializer / value: Histogram
+        self.loop_time = Histogram()
+
+    def decoded(self, _format, method: str, size: int, seconds: float):
+        self.frames_in[method] += 1
+        self.bytes_in[_format.name] += size
+        histogram = self.decode_time.get(_format.name)
+        if histogram is None:
+            histogram = self.decode_time[_format.name] = Histogram()
+        histogram.record(seconds)
+
+    def encoded(self, _format, seconds: float):
+        histogram = self.encode_time.get(_format.name)
+        if histogram is None:
+            histogram = self.encode_time[_format.name] = Histogram()
+        histogram.record(seconds)
+
+    def sent(self, _format, method: str, size: int):
+        self.frames_out[method] += 1
+        self.bytes_out[_format.name] += size
+
+    def snapshot(self, broker) -> Dict[str, Any]:
+        """Every metric, along with the current state of broker."""
+        depths = [outbound.size for outbound in broker.outbound_of_userDic.values()]
+        return {
+            "frames_in": dict(self.frames_in),
+            "frames_out": dict(self.frames_out),
+            "bytes_in": dict(self.bytes_in),
+            "bytes_out": dict(self.bytes_out),
+            "decode": {name: histogram.summary() for name, histogram in self.decode_time.items()},
+            "encode": {name: histogram.summary() for name, histogram in self.encode_time.items()},
+            "loop": self.loop_time.summary(),
+            "connections": len(broker.outbound_of_userDic),
+            "outbound_bytes": sum(depths),
+            "outbound_max_bytes": max(depths, default=0),
+            "outbound_backlogged": sum(1 for depth in depths if depth),
+            "topics": len(broker.messages_of_topicsDic),
+            "subscriptions": sum(len(topics) for topics in broker.topics_of_userDic.values()),
+        }
+
+    def render(self, broker) -> str:
+        """snapshot() as plaintext, one 'broker_name{label} value' line per metric."""
+        snapshot, lines = self.snapshot(broker), []
+        for name in ("frames_in", "frames_out"):
+            lines += ['broker_%s{method="%s"} %s' % (name, method, count)
+                      for method, count in snapshot.pop(name).items()]
+        for name in ("bytes_in", "bytes_out"):
+            lines += ['broker_%s{serializer="%s"} %s' % (name, serializer, count)
+                      for serializer, count in snapshot.pop(name).items()]
+        for name in ("decode", "encode"):
+            lines += ['broker_%s_%s{serializer="%s"} %s' % (name, stat, serializer, value)
+                      for serializer, summary in snapshot.pop(name).items()
+                      for stat, value in summary.items()]
+        lines += ['broker_loop_%s %s' % item for item in snapshot.pop("loop").items()]
+        lines += ['broker_%s %s' % item for item in snapshot.items()]
+        return "\n".join(lines) + "\n"
@@ -1,15 +1,23 @@
 """Middleware to communicate with PubSub Message Broker."""
+from collections import deque
 from collections.abc import Callable
 from enum import Enum
-from queue import LifoQueue, Empty
+from queue import Queue as MessageQueue, Empty
 from typing import Any
 from broker import Broker
+from src import binary
+from src.framing import FrameBuffer
 import socket
-import selectors
+import threading
+import time
 import json
 import pickle
 import xml.etree.ElementTree as element_tree
 import xml
+from xml.sax.saxutils import quoteattr
+
+
+CONTROL = ('REGISTERED', 'STATS', 'CREDIT')   #replies handled by the Queue itself
 
 
 class MiddlewareType(Enum):
@@ -22,63 +30,370 @@ class MiddlewareType(Enum):
 class Queue:
     """Representation of Queue interface for both Consumers and Producers."""
 
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        """Create Queue."""
-        self.host = 'localhost'
-        self.port = 5000  
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, intern_topics=False,
+                 linger=None, max_batch=100, prefetch=None, broker=None,
+                 host='localhost', port=5000, unix_path=None, nodelay=True,
+                 sndbuf=None, rcvbuf=None, group=None, window=None,
+                 flow_control=False, block=True):
+        """Create Queue.
+
+        With intern_topics, topics are registered with the broker and frames
+        carry their integer ID instead of the topic string. With a linger (in
+        seconds), push() collects values and sends them as one BATCH frame
+        once max_batch are pending or linger has passed. topic is the default
+        topic of the connection; others can be given per call. With a prefetch
+        depth, a reader thread keeps up to that many messages received ahead
+        of pull(). Given the broker itself, running in this process, the
+        queue hands it values directly instead of serializing them over TCP;
+        values are then shared, not copied. Otherwise it connects to the
+        broker at host and port, or at the Unix socket unix_path, setting
+        TCP_NODELAY and the kernel buffer sizes as asked. A consumer given a
+        group shares the messages of topic with the other members, and one
+        given a window acknowledges them (see subscribe). With flow_control,
+        every value published spends a credit granted by the broker; out of
+        credit, push() waits for more or, unless block, raises
+        BlockingIOError."""
+        self.host = host
+        self.port = port
         self.topic = topic
         self._type = _type
-        self.selector = selectors.DefaultSelector()
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.host, self.port))
-        ack_msg = json.dumps({"method": "ACK", "Serializer": str(self.__class__.__name__)}).encode('utf-8')
-        header = len(ack_msg).to_bytes(3, "little")   
-        self.socket.send(header + ack_msg)
-        self.selector.register(self.socket, selectors.EVENT_READ, self.pull)
+        self.intern_topics = intern_topics
+        self.topic_ids = {}     #key: topic / value: ID given by the broker
+        self.topic_names = {}   #key: ID    / value: topic
+        self.offset = None      #broker offset of the last message pulled
+        self.backlog = deque()  #frames received while waiting for a reply
+        self.linger = linger
+        self.max_batch = max_batch
+        self.batch = {}         #key: topic / value: values waiting for the next BATCH frame
+        self.batch_timer = None
+        self.batch_lock = threading.Lock()
+        self.prefetch = prefetch
+        self.prefetched = None  #messages read ahead by the reader thread
+        self.reader = None
+        self.callback = None
+        self.replied = threading.Condition()   #notified on REGISTERED and STATS
+        self.stats = None       #last STATS reply
+        self.credit = None      #publishes the broker allows, with flow_control
+        self.block = block
+        self.local = None       #LocalConnection to an in-process broker
+        if broker is not None:
+            self.local = broker.connect_local()
+        else:
+            if unix_path is not None:
+                self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            else:
+                self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                if nodelay:
+                    self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if sndbuf is not None:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+            if rcvbuf is not None:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+            self.socket.connect(unix_path if unix_path is not None else (self.host, self.port))
+            self.inbound = FrameBuffer()
+            ack_msg = json.dumps({"method": "ACK", "Serializer": str(self.__class__.__name__)}).encode('utf-8')
+            header = len(ack_msg).to_bytes(3, "little")   
+            self.socket.send(header + ack_msg)
 
+        if flow_control:
+            self.credit = 0
+            self.send_message('CREDIT', '')
+        if intern_topics:
+            self.register(topic)
         if self._type==MiddlewareType.CONSUMER:
-            self.subscribe(topic)
+            self.subscribe(topic, group=group, window=window)
+        if prefetch is not None:
+            self.start_reader()
+
+    def register(self, topic):
+        """Ask the broker for the ID of topic and wait for it."""
+        self.send_message('REGISTER', topic, topic)
+
+        if self.reader is not None:
+            with self.replied:
+                self.replied.wait_for(lambda: topic in self.topic_ids)
+            return
+        while topic not in self.topic_ids:
+            received = self.receive()
+            if received is None:
+                raise ConnectionError("broker closed the connection")
+            if received[0] not in CONTROL:
+                self.backlog.append(received)
+
+    def subscribe(self, topic, offset=None, last=None, group=None, balance=None, window=None):
+        """Subscribe to topic, replaying retained values from offset or the last ones.
+
+        Asking for a replay also makes the broker send the offset of every
+        message, available as self.offset after pull(). With a group, each
+        message goes to only one of its members, chosen by balance:
+        'round_robin' (the default) or 'least_outstanding'. With a window,
+        messages must be acknowledged with ack() or ack_upto(): the broker
+        keeps at most window of them unacknowledged and sends again those
+        not acknowledged in time. A window applies to the whole connection."""
+        options = {}
+        if offset is not None:
+            options['offset'] = offset
+        if last is not None:
+            options['last'] = last
+        if group is not None:
+            options['group'] = group
+        if balance is not None:
+            options['balance'] = balance
+        if window is not None:
+            options['window'] = window
+        self.send_message('SUBSCRIBE' , options or topic, topic)
+
+    def push(self, value, topic=None):
+        """Sends data to broker, in topic or the default topic."""
+        topic = topic or self.topic
+        if self.linger is None:
+            self._take_credit(1)
+            self.send_message('PUBLISH', value, self._published(topic))
+            return
+
+        with self.batch_lock:
+            batch = self.batch.setdefault(topic, [])
+            batch.append(value)
+            if len(batch) >= self.max_batch:
+                self.push_many(self.batch.pop(topic), topic)
+                if not self.batch:
+                    self._send_batch()  # nothing left to linger for
+            elif self.batch_timer is None:
+                self.batch_timer = threading.Timer(self.linger, self.flush)
+                self.batch_timer.daemon = True
+                self.batch_timer.start()
+
+    def push_many(self, values, topic=None):
+        """Sends many values to broker in a single BATCH frame."""
+        values = list(values)
+        self._take_credit(len(values))
+        self.send_message('BATCH', values, self._published(topic or self.topic))
 
-    def subscribe(self, topic):
-        self.send_message('SUBSCRIBE' , topic)
+    def _take_credit(self, count):
+        """Spend count credits, first waiting for some if there are none left."""
+        if self.credit is None:
+            return
+        if self.credit <= 0:
+            self._wait_credit()
+        with self.replied:
+            if self.credit <= 0:
+                raise BlockingIOError("out of publish credits")
+            self.credit -= count
 
-    def push(self, value):
-        """Sends data to broker. """
-        print(value)
-        self.send_message('PUBLISH', value)
+    def _wait_credit(self):
+        if self.reader is not None:
+            with self.replied:
+                self.replied.wait_for(lambda: self.credit > 0, None if self.block else 0)
+            return
 
+        if self.local is None:
+            self.socket.setblocking(self.block)
+        try:
+            while self.credit <= 0:
+                received = self.receive(self.block)
+                if received is None:
+                    raise ConnectionError("broker closed the connection")
+                if received[0] not in CONTROL:
+                    self.backlog.append(received)
+        except (BlockingIOError, Empty):
+            pass    # nothing granted yet
+        finally:
+            if self.local is None:
+                self.socket.setblocking(True)
+
+    def _published(self, topic):
+        """Registers topic first if topics are interned and it is new."""
+        if self.intern_topics and topic not in self.topic_ids:
+            self.register(topic)
+        return topic
+
+    def flush(self):
+        """Sends the values push() is holding back, if any."""
+        with self.batch_lock:
+            self._send_batch()
+
+    def _send_batch(self):
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        batches, self.batch = self.batch, {}
+        for topic, batch in batches.items():
+            self.push_many(batch, topic)
+
+
+    def start_reader(self, prefetch=1000):
+        """Read messages from a background thread from now on.
+
+        Up to the prefetch depth given to the Queue, or else prefetch,
+        messages are kept ready for pull(); past that the reader stops
+        draining the socket until they are pulled."""
+        if self.reader is not None:
+            return
+        self.prefetched = MessageQueue(maxsize=self.prefetch or prefetch)
+        self.reader = threading.Thread(target=self._read_ahead, daemon=True)
+        self.reader.start()
+
+    def _read_ahead(self):
+        while True:
+            received = self.backlog.popleft() if self.backlog else self.receive()
+            if received is None:
+                self.prefetched.put(None)
+                return
+            if received[0] in CONTROL:
+                continue
+            if self.callback is not None:
+                self.callback(*self._delivery(received))
+            else:
+                self.prefetched.put(received)
+
+    def on_message(self, callback: Callable):
+        """Call callback(topic, data) from the reader thread for every message."""
+        self.callback = callback
+        self.start_reader()
 
     def pull(self) -> (str, Any):
         """Waits for (topic, data) from broker.
         Should BLOCK the consumer!"""
-        
-        header = self.socket.recv(3)                        
-        header = int.from_bytes(header, "little")  
-        data = self.socket.recv(header)
-        
-        if data:           
-            method, topic, msg = self.decode(data)   
-            return topic, msg    
+        if self.reader is not None:
+            received = self.prefetched.get()
+            if received is None:
+                self.prefetched.put(None)   # closed; later pulls return None too
+                return None
+            return self._delivery(received)
+
+        received = self.backlog.popleft() if self.backlog else self.receive()
+        while received is not None and received[0] in CONTROL:
+            received = self.receive()
+        if received is None:
+            return None
+        return self._delivery(received)
+
+    def pull_many(self, n, timeout=None) -> list:
+        """Waits up to timeout seconds for a first message, then returns up to n
+        (topic, data) pairs that are ready, without waiting for more."""
+        self.start_reader()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        messages = []
+        while len(messages) < n:
+            try:
+                if messages:
+                    received = self.prefetched.get_nowait()
+                else:
+                    wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                    received = self.prefetched.get(timeout=wait)
+            except Empty:
+                break
+            if received is None:
+                self.prefetched.put(None)
+                break
+            messages.append(self._delivery(received))
+        return messages
+
+    def _delivery(self, received):
+        method, topic, msg, self.offset = received
+        if isinstance(topic, int):
+            topic = self.topic_names[topic]
+        return topic, msg
+
+    def receive(self, block=True):
+        """Waits for the next frame from the broker and decodes it.
+
+        Topic IDs announced by the broker are recorded on the way. Without
+        block, an in-process queue raises Empty when nothing was delivered."""
+        if self.local is not None:
+            received = self.local.deliveries.get(block=block)
+            if received is None:
+                return None
+        else:
+            data = self.inbound.next_frame()
+            while data is None:
+                if not self.inbound.recv_from(self.socket):
+                    return None
+                data = self.inbound.next_frame()
+            received = self.decode(data)
+
+        if received[0] == 'REGISTERED':
+            with self.replied:
+                self.topic_ids[received[1]] = int(received[2])
+                self.topic_names[int(received[2])] = received[1]
+                self.replied.notify_all()
+        elif received[0] == 'CREDIT':
+            with self.replied:
+                self.credit += int(received[2])
+                self.replied.notify_all()
+        elif received[0] == 'STATS':
+            with self.replied:
+                self.stats = received[2]
+                self.replied.notify_all()
+        return received
+
+    def request_stats(self, text=False):
+        """Ask the broker for its metrics and wait for them.
+
+        Returns a dict, or with text the plaintext dump."""
+        with self.replied:
+            self.stats = None
+        self.send_message('STATS', 'text' if text else '')
+
+        if self.reader is not None:
+            with self.replied:
+                self.replied.wait_for(lambda: self.stats is not None)
+            return self.stats
+        while self.stats is None:
+            received = self.receive()
+            if received is None:
+                raise ConnectionError("broker closed the connection")
+            if received[0] not in CONTROL:
+                self.backlog.append(received)
+        return self.stats
+
+    def ack(self, offset=None):
+        """Acknowledge the message with offset, by default the last one pulled."""
+        self.send_message('ACK', self.offset if offset is None else offset)
+
+    def ack_upto(self, offset=None):
+        """Acknowledge every message up to offset, by default the last one pulled."""
+        self.send_message('ACK', {'upto': self.offset if offset is None else offset})
 
     def list_topics(self, callback: Callable):
         """Lists all topics available in the broker."""
         self.send_message('LIST', '')
 
-    def cancel(self):
-        """Cancel subscription."""
-        self.send_message('CANCEL', self.topic)
+    def cancel(self, topic=None):
+        """Cancel subscription to topic or the default topic."""
+        topic = topic or self.topic
+        self.send_message('CANCEL', topic, topic)
+
+    def close(self):
+        """Send what push() is holding back and close the connection.
 
-    def send_message(self, method, message):
-        """Sends through a connection a Message object."""
-        data = self.encode(method, self.topic, message) 
+        The broker then drops every subscription of this queue."""
+        if self.linger is not None:
+            self.flush()
+        if self.local is not None:
+            self.local.close()
+            return
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)  # wakes a reader thread blocked in recv
+        except OSError:
+            pass    # already closed by the broker
+        self.socket.close()
+
+    def send_message(self, method, message, topic=None):
+        """Sends through a connection a Message object about topic or the default topic."""
+        topic = topic or self.topic
+        if self.local is not None:
+            self.local.send(method, self.topic_ids.get(topic, topic), message)
+            return
+        data = self.encode(method, self.topic_ids.get(topic, topic), message) 
         header = len(data).to_bytes(3, "little")  
         self.socket.send(header + data)       
 
 class JSONQueue(Queue):
     """Queue implementation with JSON based serialization."""
     
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):  
-        super().__init__(topic, _type)
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **options):  
+        super().__init__(topic, _type, **options)
     
     def encode(self, method, topic, message):
         msg_JSON = {'method': method, 'topic': topic, 'msg': message}
@@ -88,41 +403,50 @@ class JSONQueue(Queue):
         return msg_JSON   
      
     def decode(self, data):
-        data = data.decode('utf-8')
+        data = str(data, 'utf-8')
         message = json.loads(data)
         method = message['method']
         topic = message['topic']
+        offset = message.get('offset')
         message = message['msg']
         
-        return method, topic, message  
+        return method, topic, message, offset
 
 class XMLQueue(Queue):
     """Queue implementation with XML based serialization."""
     
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **options):
+        super().__init__(topic, _type, **options)
         
     def encode(self,method, topic, msg):
-        msg_XML = {'method': method, 'topic': topic, 'msg': msg}
-        msg_XML = ('<?xml version="1.0"?><data method="%(method)s" topic="%(topic)s"><msg>%(msg)s</msg></data>' % msg_XML)
+        options = ''
+        if method == 'BATCH':
+            msg = '</msg><msg>'.join(str(value) for value in msg)
+        elif method == 'SUBSCRIBE' and isinstance(msg, dict):
+            options = ''.join(' %s=%s' % (key, quoteattr(str(value))) for key, value in msg.items())
+            msg = ''
+        msg_XML = {'method': method, 'topic': topic, 'msg': msg, 'options': options,
+                   'topic_attr': 'topic_id' if isinstance(topic, int) else 'topic'}
+        msg_XML = ('<?xml version="1.0"?><data method="%(method)s" %(topic_attr)s="%(topic)s"><msg%(options)s>%(msg)s</msg></data>' % msg_XML)
         msg_XML = msg_XML.encode('utf-8')
         
         return msg_XML
     
     def decode(self, data):
-        data = data.decode('utf-8')
+        data = str(data, 'utf-8')
         data = element_tree.fromstring(data)
         data_aux = data.attrib
         method = data_aux['method']
-        topic= data_aux['topic']
+        topic = int(data_aux['topic_id']) if 'topic_id' in data_aux else data_aux['topic']
+        offset = int(data_aux['offset']) if 'offset' in data_aux else None
         message = data.find('msg').text
 
-        return method, topic, message
+        return method, topic, message, offset
 
 class PickleQueue(Queue):
     """Queue implementation with Pickle based serialization."""
-    def __init__(self, topic, _type=MiddlewareType.CONSUMER):
-        super().__init__(topic, _type)
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **options):
+        super().__init__(topic, _type, **options)
         
     def encode(self,method, topic, message):
         msg_PICKLE = {'method': method, 'topic': topic, 'msg': message}
@@ -134,7 +458,19 @@ class PickleQueue(Queue):
         data = pickle.loads(data)
         method = data['method']
         topic = data['topic']
+        offset = data.get('offset')
         message = data['msg']
         
-        return method, topic, message
+        return method, topic, message, offset
+
 
+class BinaryQueue(Queue):
+    """Queue implementation with a compact binary serialization."""
+    def __init__(self, topic, _type=MiddlewareType.CONSUMER, **options):
+        super().__init__(topic, _type, **options)
+
+    def encode(self, method, topic, message):
+        return binary.encode(method, topic, message)
+
+    def decode(self, data):
+        return binary.decode(data)
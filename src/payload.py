@@ -0,0 +1,37 @@
+"""Published values kept in the encoding they arrived in."""
+from typing import Any, Callable
+
+
+class Payload:
+    """The msg of a published frame, still encoded in _format.
+
+    The broker routes on method and topic alone, so the value is only
+    decoded, once, when it has to be sent in another format or stored.
+    Subscribers using _format get raw spliced into their frames."""
+
+    __slots__ = ("format", "raw", "_decode", "_value")
+
+    def __init__(self, _format, raw: bytes, decode: Callable[[bytes], Any]):
+        self.format = _format
+        self.raw = raw
+        self._decode = decode
+        self._value = None
+
+    @property
+    def value(self) -> Any:
+        if self._decode is not None:
+            self._value = self._decode(self.raw)
+            self._decode = None
+        return self._value
+
+    def __sizeof__(self) -> int:
+        return object.__sizeof__(self) + len(self.raw)
+
+    def __repr__(self):
+        return "Payload(%s, %r)" % (self.format, self.raw)
+
+
+def materialize(value: Any) -> Any:
+    """value itself, or the decoded value of a Payload."""
+    return value.value if type(value) is Payload else value
+
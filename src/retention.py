@@ -0,0 +1,68 @@
+"""Bounded log of the latest values published to a topic."""
+from array import array
+from typing import Any, List, Tuple
+import sys
+
+
+def sizeof(value: Any) -> int:
+    """Approximate size of a value in bytes."""
+    if isinstance(value, (str, bytes, bytearray, memoryview)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class RetentionLog:
+    """Ring buffer of (offset, value) bounded by count and by bytes.
+
+    All slots are allocated up front, so a topic's memory does not grow
+    with the number of values published to it.
+    """
+
+    __slots__ = ("values", "offsets", "sizes", "start", "count", "size", "max_bytes")
+
+    def __init__(self, capacity: int, max_bytes: int):
+        """Create an empty log of capacity slots holding at most max_bytes."""
+        self.values = [None] * capacity
+        self.offsets = array('q', bytes(8 * capacity))
+        self.sizes = array('q', bytes(8 * capacity))
+        self.start = 0      #slot of the oldest value
+        self.count = 0      #values retained
+        self.size = 0       #bytes retained
+        self.max_bytes = max_bytes
+
+    def append(self, offset: int, value: Any, size: int):
+        """Add value, evicting the oldest ones to stay within bounds.
+
+        The newest value is always kept, even if it alone exceeds max_bytes."""
+        capacity = len(self.values)
+        while self.count and (self.count == capacity or self.size + size > self.max_bytes):
+            self._evict()
+
+        slot = (self.start + self.count) % capacity
+        self.values[slot] = value
+        self.offsets[slot] = offset
+        self.sizes[slot] = size
+        self.count += 1
+        self.size += size
+
+    def _evict(self):
+        self.values[self.start] = None
+        self.size -= self.sizes[self.start]
+        self.start = (self.start + 1) % len(self.values)
+        self.count -= 1
+
+    def last(self, n: int) -> List[Tuple[int, Any]]:
+        """The newest n (offset, value) pairs, oldest first."""
+        return self._entries(max(self.count - n, 0))
+
+    def since(self, offset: int) -> List[Tuple[int, Any]]:
+        """Every retained (offset, value) pair from offset onwards."""
+        skip = 0
+        while skip < self.count and self.offsets[(self.start + skip) % len(self.values)] < offset:
+            skip += 1
+        return self._entries(skip)
+
+    def _entries(self, skip: int) -> List[Tuple[int, Any]]:
+        capacity = len(self.values)
+        slots = [(self.start + i) % capacity for i in range(skip, self.count)]
+        return [(self.offsets[slot], self.values[slot]) for slot in slots]
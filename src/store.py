@@ -0,0 +1,157 @@
+"""Append-only, memory-mapped log of published values.
+
+Each record is a complete LAST_POST wire frame in the binary layout (see
+src.binary) carrying the topic and offset of the value. Segments are
+preallocated files mapped into memory; a zero length marks the end of the
+records written to one. Starting up only reads the record headers, and
+replaying to a BinaryQueue sends the records straight from the mapping.
+"""
+from bisect import bisect_right
+from typing import Iterator, List, Tuple
+import mmap
+import os
+import time
+
+from src import binary
+
+LAST_POST = binary.OPCODES['LAST_POST'] | binary.OFFSET
+
+
+class SegmentStore:
+    """Segment files in directory holding every published value."""
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024,
+                 fsync_interval: float = 1.0, index_interval: int = 64):
+        """Open the segments in directory, creating it if needed.
+
+        Writes are flushed to disk at most every fsync_interval seconds. One
+        record in every index_interval of a topic is kept in its index."""
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.index_interval = index_interval
+        self.segments = []          #mmap of each segment, oldest first
+        self.position = 0           #end of the records in the last segment
+        self.next_offset = 0        #offset following the newest record
+        self.dirty = False
+        self.synced = time.monotonic()
+        self.offsets_of_topicDic = {}   #key: topic / value: indexed offsets
+        self.positions_of_topicDic = {} #key: topic / value: (segment, position) of each indexed offset
+        self.count_of_topicDic = {}     #key: topic / value: records stored
+        self.last_of_topicDic = {}      #key: topic / value: (segment, position) of the newest record
+
+        os.makedirs(directory, exist_ok=True)
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.log'):
+                self.segments.append(self._map(os.path.join(directory, name)))
+                self.position = self._scan(len(self.segments) - 1)
+
+    def _map(self, path: str, size: int = 0) -> mmap.mmap:
+        with open(path, 'a+b') as segment:
+            if size:
+                segment.truncate(size)
+            return mmap.mmap(segment.fileno(), 0)
+
+    def _scan(self, segment: int) -> int:
+        """Index the records of a segment from their headers. Returns where they end."""
+        mapping, position = self.segments[segment], 0
+        while position + binary.HEADER.size + 3 <= len(mapping):
+            size = int.from_bytes(mapping[position:position + 3], 'little')
+            if not size:
+                break
+            _, topic_size = binary.HEADER.unpack_from(mapping, position + 3)
+            start = position + 3 + binary.HEADER.size
+            topic = str(mapping[start:start + topic_size], 'utf-8')
+            offset = binary.INT.unpack_from(mapping, start + topic_size)[0]
+            self._index(topic, offset, segment, position)
+            position += 3 + size
+        return position
+
+    def _index(self, topic: str, offset: int, segment: int, position: int):
+        count = self.count_of_topicDic.get(topic, 0)
+        if count % self.index_interval == 0:
+            self.offsets_of_topicDic.setdefault(topic, []).append(offset)
+            self.positions_of_topicDic.setdefault(topic, []).append((segment, position))
+        self.count_of_topicDic[topic] = count + 1
+        self.last_of_topicDic[topic] = (segment, position)
+        self.next_offset = max(self.next_offset, offset + 1)
+
+    def append(self, topic: str, offset: int, value) -> bool:
+        """Store value, published to topic with offset.
+
+        Returns False for values the binary layout cannot hold, which are
+        not stored."""
+        try:
+            record = binary.encode('LAST_POST', topic, value, offset)
+        except (TypeError, ValueError):
+            return False
+        record = len(record).to_bytes(3, 'little') + record
+
+        if not self.segments or self.position + len(record) + 3 > len(self.segments[-1]):
+            self.roll(offset, len(record) + 3)
+        mapping = self.segments[-1]
+        mapping[self.position:self.position + len(record)] = record
+        self._index(topic, offset, len(self.segments) - 1, self.position)
+        self.position += len(record)
+
+        self.dirty = True
+        if time.monotonic() - self.synced >= self.fsync_interval:
+            self.sync()
+        return True
+
+    def roll(self, offset: int, size: int):
+        """Start a new segment, named after its first offset, of at least size bytes."""
+        if self.segments:
+            self.sync()
+        path = os.path.join(self.directory, '%020d.log' % offset)
+        self.segments.append(self._map(path, max(self.segment_bytes, size)))
+        self.position = 0
+
+    def sync(self):
+        """Flush the records written since the last sync to disk."""
+        if self.dirty:
+            self.segments[-1].flush()
+            self.dirty = False
+        self.synced = time.monotonic()
+
+    def topics(self) -> List[str]:
+        """Every topic with stored records."""
+        return list(self.last_of_topicDic)
+
+    def frame(self, segment: int, position: int) -> memoryview:
+        """The record at position of segment, as a wire frame."""
+        mapping = self.segments[segment]
+        size = int.from_bytes(mapping[position:position + 3], 'little')
+        return memoryview(mapping)[position:position + 3 + size]
+
+    def last(self, topic: str) -> Tuple[int, object]:
+        """The (offset, value) of the newest record of topic."""
+        _, _, value, offset = binary.decode(self.frame(*self.last_of_topicDic[topic])[3:])
+        return offset, value
+
+    def since(self, topic: str, offset: int) -> Iterator[Tuple[int, memoryview]]:
+        """Yields (offset, frame) of every record of topic from offset onwards.
+
+        The sparse index gives the record to start from; records of other
+        topics after it are skipped by their header alone."""
+        offsets = self.offsets_of_topicDic.get(topic)
+        if not offsets:
+            return
+        segment, position = self.positions_of_topicDic[topic][max(bisect_right(offsets, offset) - 1, 0)]
+        name = topic.encode('utf-8')
+        header = binary.HEADER.pack(LAST_POST, len(name)) + name
+
+        while segment < len(self.segments):
+            mapping = self.segments[segment]
+            end = self.position if segment == len(self.segments) - 1 else len(mapping)
+            while position + 3 <= end:
+                size = int.from_bytes(mapping[position:position + 3], 'little')
+                if not size:
+                    break
+                start = position + 3
+                if mapping[start:start + len(header)] == header:
+                    record = binary.INT.unpack_from(mapping, start + len(header))[0]
+                    if record >= offset:
+                        yield record, self.frame(segment, position)
+                position = start + size
+            segment, position = segment + 1, 0
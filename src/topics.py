@@ -0,0 +1,170 @@
+"""Hierarchical topic index used by the broker to match subscriptions."""
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+SEPARATOR = "/"
+SINGLE = "+"    #matches exactly one segment
+MULTI = "#"     #matches every remaining segment, if any; only last
+
+
+ROUND_ROBIN = "round_robin"
+LEAST_OUTSTANDING = "least_outstanding"
+
+
+class ConsumerGroup:
+    """Subscribers of a topic sharing its messages, each going to one member."""
+
+    __slots__ = ("name", "balance", "members", "next")
+
+    def __init__(self, name: str, balance: str = ROUND_ROBIN):
+        if balance not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise ValueError("unknown balance %s" % balance)
+        self.name = name
+        self.balance = balance
+        self.members = []   #list of (address, format)
+        self.next = 0       #index of the member to try first
+
+    def pick(self, outstanding: Callable[[Any], int]) -> Tuple[Any, Any]:
+        """The (address, format) of the member to get the next message.
+
+        With LEAST_OUTSTANDING, that is the member with the fewest messages
+        outstanding(address) reports, ties going round-robin."""
+        count = len(self.members)
+        chosen = self.next % count
+        if self.balance == LEAST_OUTSTANDING:
+            fewest = outstanding(self.members[chosen][0])
+            for step in range(1, count):
+                index = (self.next + step) % count
+                pending = outstanding(self.members[index][0])
+                if pending < fewest:
+                    chosen, fewest = index, pending
+        self.next = chosen + 1
+        return self.members[chosen]
+
+
+class _TopicNode:
+    """One '/'-separated segment of a topic."""
+
+    __slots__ = ("children", "subscribers", "groups")
+
+    def __init__(self):
+        self.children = {}      #key: segment / value: _TopicNode
+        self.subscribers = []   #list of (address, format)
+        self.groups = {}        #key: group name / value: ConsumerGroup
+
+
+class TopicTrie:
+    """Trie of subscriptions keyed on topic segments.
+
+    Subscribing to a topic also subscribes to every topic below it, so the
+    subscribers of a published topic are found by walking its ancestors only.
+    Wildcard segments are children like any other, so matching a topic walks
+    at most one path per wildcard that fits it, whatever the number of
+    subscriptions.
+    """
+
+    def __init__(self):
+        """Initialize an empty trie."""
+        self.root = _TopicNode()
+
+    @staticmethod
+    def split(topic: str) -> List[str]:
+        """Split a topic into its segments."""
+        return topic.split(SEPARATOR)
+
+    def find(self, topic: str) -> Optional[_TopicNode]:
+        """Returns the node of topic, or None if nobody ever subscribed to it."""
+        node = self.root
+        for segment in self.split(topic):
+            node = node.children.get(segment)
+            if node is None:
+                return None
+        return node
+
+    def subscribe(self, topic: str, address: Any, _format: Any = None,
+                  group: str = None, balance: str = ROUND_ROBIN):
+        """Register address as a subscriber of topic, which may hold wildcards.
+
+        Given a group, address joins the ConsumerGroup of that name on topic,
+        created with balance if it is the first member."""
+        segments = self.split(topic)
+        if MULTI in segments[:-1]:
+            raise ValueError("'%s' must be the last segment of %s" % (MULTI, topic))
+        node = self.root
+        for segment in segments:
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _TopicNode()
+            node = child
+        if group is None:
+            node.subscribers.append((address, _format))
+        else:
+            consumers = node.groups.get(group)
+            if consumers is None:
+                consumers = node.groups[group] = ConsumerGroup(group, balance or ROUND_ROBIN)
+            consumers.members.append((address, _format))
+
+    def unsubscribe(self, topic: str, address: Any) -> bool:
+        """Remove address from the subscribers of topic, pruning empty nodes."""
+        path = [self.root]
+        segments = self.split(topic)
+        for segment in segments:
+            node = path[-1].children.get(segment)
+            if node is None:
+                return False
+            path.append(node)
+
+        node = path[-1]
+        if not self._remove(node, address):
+            return False
+
+        for segment, parent in zip(reversed(segments), reversed(path[:-1])):
+            child = parent.children[segment]
+            if child.subscribers or child.children or child.groups:
+                break
+            del parent.children[segment]
+        return True
+
+    @staticmethod
+    def _remove(node: _TopicNode, address: Any) -> bool:
+        """Remove address from the subscribers or a group of node."""
+        for subscription in node.subscribers:
+            if subscription[0] == address:
+                node.subscribers.remove(subscription)
+                return True
+        for name, consumers in node.groups.items():
+            for member in consumers.members:
+                if member[0] == address:
+                    consumers.members.remove(member)
+                    if not consumers.members:
+                        del node.groups[name]
+                    return True
+        return False
+
+    def subscribers(self, topic: str) -> List[Tuple[Any, Any]]:
+        """Subscribers registered exactly on topic."""
+        node = self.find(topic)
+        return node.subscribers if node is not None else []
+
+    def matches(self, topic: str) -> Iterator[_TopicNode]:
+        """Yield the nodes with subscribers or groups matching topic or one of its ancestors."""
+        nodes = [self.root]
+        for segment in self.split(topic):
+            following = []
+            for node in nodes:
+                multi = node.children.get(MULTI)
+                if multi is not None and (multi.subscribers or multi.groups):
+                    yield multi
+                for key in (segment, SINGLE) if segment != SINGLE else (SINGLE,):
+                    child = node.children.get(key)
+                    if child is not None:
+                        following.append(child)
+                        if child.subscribers or child.groups:
+                            yield child
+            if not following:
+                return
+            nodes = following
+
+        for node in nodes:
+            multi = node.children.get(MULTI)
+            if multi is not None and (multi.subscribers or multi.groups):
+                yield multi
@@ -0,0 +1,63 @@
+"""Multi-process PubSub Message Broker."""
+import itertools
+import os
+import signal
+import socket
+
+from src.broker import Broker
+
+
+def run_workers(workers: int = None, **options):
+    """Run the broker as workers forked processes sharing one port.
+
+    Every worker binds the port with SO_REUSEPORT, so the kernel spreads
+    client connections across them. Each pair of workers is linked by a Unix
+    socket pair over which locally published values are forwarded, so a
+    subscriber on one worker gets publishes that arrive on any other, and
+    list_topics/get_topic agree on every worker. options are passed on to
+    each worker's Broker; a data_dir gets a subdirectory per worker. Workers
+    only listen on TCP.
+    """
+    if options.get('unix_path') is not None:
+        raise ValueError("workers share a TCP port; unix_path is not supported")
+    if options.get('bridges'):
+        raise ValueError("bridge a single broker process; workers would each forward every publish")
+    workers = workers or os.cpu_count() or 1
+    links = {pair: socket.socketpair() for pair in itertools.combinations(range(workers), 2)}
+
+    children = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            if options.get('data_dir') is not None:
+                options['data_dir'] = os.path.join(options['data_dir'], str(worker_id))
+            broker = Broker(reuse_port=True, worker_id=worker_id, **options)
+            for (first, second), (sock_first, sock_second) in links.items():
+                if first == worker_id:
+                    broker.add_peer(sock_first)
+                    sock_second.close()
+                elif second == worker_id:
+                    broker.add_peer(sock_second)
+                    sock_first.close()
+                else:
+                    sock_first.close()
+                    sock_second.close()
+            try:
+                broker.run()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    for sock_first, sock_second in links.values():
+        sock_first.close()
+        sock_second.close()
+
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,41 @@
+"""Helpers shared by the tests that talk to a broker frame by frame."""
+import json
+import random
+import socket
+import string
+from unittest.mock import MagicMock
+
+from src.broker import OutboundBuffer
+
+TOPIC = "".join(random.sample(string.ascii_lowercase, 6))
+
+
+def gen():
+    while True:
+        yield random.randint(0, 100)
+
+
+def frame(data):
+    return len(data).to_bytes(3, "little") + data
+
+
+def connect(address, serializer="JSONQueue"):
+    """Open a client connection to address and announce serializer."""
+    conn = socket.create_connection(address)
+    conn.sendall(frame(json.dumps({"method": "ACK", "Serializer": serializer}).encode("utf-8")))
+    return conn
+
+
+def request(conn, method, topic, msg):
+    conn.sendall(frame(json.dumps({"method": method, "topic": topic, "msg": msg}).encode("utf-8")))
+
+
+def fake_connection(broker, accept=None):
+    """Mock connection of broker whose sendmsg takes at most accept bytes per call."""
+    conn = MagicMock()
+    conn.sendmsg.side_effect = lambda buffers, *args: min(
+        sum(len(b) for b in buffers), accept if accept is not None else 1 << 30
+    )
+    if broker is not None:
+        broker.outbound_of_userDic[conn] = OutboundBuffer()
+    return conn
@@ -0,0 +1,69 @@
+"""Test the asyncio broker engine on the wire."""
+import json
+import pickle
+import threading
+import time
+
+import pytest
+
+from src.async_broker import AsyncBroker
+from src.framing import FrameBuffer
+from tests.helpers import connect, frame
+
+
+@pytest.fixture
+def async_broker():
+    broker = AsyncBroker(port=0)
+
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+    while broker.server is None or not broker.server.is_serving():
+        time.sleep(0.01)
+    yield broker
+    broker.canceled = True
+    thread.join(timeout=5)
+
+
+def test_async_fan_out(async_broker):
+    port = async_broker.server.sockets[0].getsockname()[1]
+
+    consumers = [connect(("localhost", port), "PickleQueue") for _ in range(3)]
+    for consumer in consumers:
+        consumer.sendall(frame(pickle.dumps({"method": "SUBSCRIBE", "topic": "/a", "msg": "/a"})))
+
+    producer = connect(("localhost", port))
+    time.sleep(0.1)
+    producer.sendall(
+        b"".join(
+            frame(json.dumps({"method": "PUBLISH", "topic": "/a/b", "msg": i}).encode("utf-8"))
+            for i in range(10)
+        )
+    )
+
+    for consumer in consumers:
+        inbound, received = FrameBuffer(), []
+        while len(received) < 10:
+            inbound.recv_from(consumer)
+            received += [pickle.loads(data)["msg"] for data in inbound.frames()]
+        assert received == list(range(10))
+
+    assert async_broker.list_topics() == ["/a/b"]
+    assert async_broker.get_topic("/a/b") == 9
+
+
+def test_async_store_synced(tmp_path):
+    broker = AsyncBroker(port=0, data_dir=str(tmp_path), fsync_interval=3600)
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+    while broker.server is None or not broker.server.is_serving():
+        time.sleep(0.01)
+    producer = connect(("localhost", broker.server.sockets[0].getsockname()[1]))
+    producer.sendall(frame(json.dumps({"method": "PUBLISH", "topic": "/kept", "msg": 1}).encode("utf-8")))
+
+    deadline = time.monotonic() + 5
+    while (broker.get_topic("/kept") != 1 or broker.store.dirty) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not broker.store.dirty   # synced while idle, long before fsync_interval
+    broker.canceled = True
+    thread.join(timeout=5)
+    producer.close()
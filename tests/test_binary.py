@@ -0,0 +1,61 @@
+"""Test the binary serializer and interned topic IDs."""
+from unittest.mock import MagicMock, patch
+
+from src import binary
+from src.broker import Serializer
+from src.clients import Consumer, Producer
+from src.middleware import BinaryQueue, JSONQueue, XMLQueue
+from tests.helpers import TOPIC, fake_connection, gen
+
+
+def test_simple_producer_BINARY(broker):
+
+    producer = Producer(TOPIC, gen, BinaryQueue)
+
+    with patch("socket.socket.send", MagicMock()) as send:
+        producer.run(1)
+
+        data_sent = send.call_args[0][0]
+
+        assert int.from_bytes(data_sent[:3], "little") == len(data_sent) - 3
+        assert binary.decode(data_sent[3:]) == ("PUBLISH", TOPIC, producer.produced[0], None)
+
+
+def test_binary_payloads():
+    for message in [None, True, -7, 1 << 70, 2.5, "mar salgado", b"\x00\xff", [1, "a"]]:
+        assert binary.decode(binary.encode("MESSAGE", "/a/b", message)) == (
+            "MESSAGE",
+            "/a/b",
+            message,
+            None,
+        )
+    assert binary.decode(binary.encode("MESSAGE", 7, "x", offset=42)) == ("MESSAGE", 7, "x", 42)
+
+
+def test_interned_topics(broker):
+    topic = "/" + TOPIC + "/interned"
+    consumer = Consumer(topic, XMLQueue, intern_topics=True)
+    producer = Producer(topic, gen, JSONQueue, intern_topics=True)
+    topic_id = producer.queue.topic_ids[topic]
+
+    queue = producer.queue
+    with patch.object(queue, "encode", MagicMock(side_effect=queue.encode)) as encode:
+        producer.run(1)
+
+        assert encode.call_args[0][:2] == ("PUBLISH", topic_id)
+
+    consumer.run(1)
+    assert consumer.received == [str(producer.produced[0])]
+    assert broker.get_topic(topic) == producer.produced[0]
+
+
+def test_unknown_topic_id(broker):
+    publisher = fake_connection(broker)
+    broker.serializer_of_userDic[publisher] = Serializer.JSON
+    topics = broker.list_topics()
+
+    for topic_id in (len(broker.topic_names), -1):
+        broker.dispatch(publisher, "PUBLISH", topic_id, "lost")
+    assert broker.list_topics() == topics  # dropped, nothing published
+
+    broker.disconnect(publisher)
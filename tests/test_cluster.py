@@ -0,0 +1,110 @@
+"""Test brokers bridged into a cluster"""
+import socket
+import threading
+import time
+
+import pytest
+
+from src.broker import Broker, Serializer
+from src.cluster import SeenMessages, aggregate
+from src.middleware import JSONQueue, MiddlewareType
+from tests.helpers import fake_connection
+
+
+def test_aggregate():
+    assert aggregate(["/a/b", "/a", "/ab", "/c/d", "/c/d/e", "/a"]) == ["/a", "/ab", "/c/d"]
+
+
+def test_seen_messages():
+    seen = SeenMessages(capacity=2)
+    assert seen.add(("a", "x", 1)) and not seen.add(("a", "x", 1))
+    assert seen.add(("a", "y", 1))  # the same offset after a restart
+    seen.add(("a", "x", 2))
+    assert seen.add(("a", "x", 1))  # forgotten beyond capacity
+
+
+@pytest.fixture
+def cluster(request):
+    """Brokers bridged along the (from, to) pairs of request.param."""
+    brokers = {name: Broker(port=0, node_id=name) for name in "abc"}
+    for source, target in request.param:
+        brokers[source].unbridged.append(("localhost", brokers[target].socket.getsockname()[1]))
+    threads = [threading.Thread(target=broker.run, daemon=True) for broker in brokers.values()]
+    for thread in threads:
+        thread.start()
+    yield brokers
+    for broker in brokers.values():
+        broker.canceled = True
+    for thread in threads:
+        thread.join(timeout=5)
+
+
+def interested(broker, topic, bridges):
+    """Wait until topic is asked for over bridges of broker."""
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        if sum(len(node.subscribers) for node in broker.interest.matches(topic)) >= bridges:
+            return
+        time.sleep(0.05)
+    raise AssertionError("interest in %s never reached %s" % (topic, broker.node_id))
+
+
+def port(broker):
+    return broker.socket.getsockname()[1]
+
+
+@pytest.mark.parametrize("cluster", [[("a", "b"), ("b", "c")]], indirect=True)
+def test_chain(cluster):
+    consumer = JSONQueue("/site/c", port=port(cluster["c"]))
+    interested(cluster["a"], "/site/c/temp", 1)
+
+    producer = JSONQueue("/site", MiddlewareType.PRODUCER, port=port(cluster["a"]))
+    producer.push(21, "/site/b")    # nobody asked for it, kept on a
+    producer.push(42, "/site/c/temp")
+    assert consumer.pull() == ("/site/c/temp", 42)
+    assert "/site/b" not in cluster["b"].messages_of_topicsDic
+
+
+@pytest.mark.parametrize("cluster", [[("a", "b"), ("b", "c"), ("c", "a")]], indirect=True)
+def test_triangle(cluster):
+    consumers = [JSONQueue("/ring", port=port(cluster[name])) for name in "bc"]
+    interested(cluster["a"], "/ring", 2)
+
+    producer = JSONQueue("/ring", MiddlewareType.PRODUCER, port=port(cluster["a"]))
+    producer.push_many(range(3))
+    for consumer in consumers:
+        received = []
+        while len(received) < 4:
+            batch = consumer.pull_many(4, timeout=1)
+            if not batch:
+                break
+            received += [value for _, value in batch]
+        assert received == [0, 1, 2]    # each once, although two paths lead there
+
+
+def test_unreachable_bridge():
+    broker = Broker(port=0, node_id="lonely")
+    closed = socket.socket()
+    closed.bind(("localhost", 0))
+    address = ("localhost", closed.getsockname()[1])
+    closed.close()      # nothing listens there
+    broker.unbridged.append(address)
+    broker.connect_bridges()
+    assert address not in broker.unbridged     # dialing without waiting
+    deadline = time.monotonic() + 5
+    while address not in broker.unbridged and time.monotonic() < deadline:
+        for key, mask in broker.selector.select(timeout=0.1):
+            key.data(key.fileobj, mask)
+    assert address in broker.unbridged and not broker.bridges     # retried later
+    broker.socket.close()
+
+
+def test_restarted_origin():
+    broker = Broker(port=0, node_id="b")
+    bridge = fake_connection(broker)
+    broker.bridges[bridge] = "a"
+    broker.serializer_of_userDic[bridge] = Serializer.PICKLE
+    for epoch, value in [("x", 1), ("x", 2), ("y", 3)]:
+        broker.dispatch(bridge, 'BRIDGE', "/restart", ["a", epoch, 0, ["a"], value])
+    assert broker.get_topic("/restart") == 3   # offset 0 again, but a new run of a
+    broker.socket.close()
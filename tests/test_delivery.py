@@ -0,0 +1,99 @@
+"""Test how the broker encodes and writes out what is published."""
+import json
+from unittest.mock import MagicMock, patch
+
+from src.broker import OutboundBuffer, Serializer
+from tests.helpers import fake_connection
+
+
+def test_encode_once(broker):
+    fake_subscribers = [fake_connection(broker) for _ in range(5)]
+    for fake_subscriber in fake_subscribers:
+        broker.subscribe("/t6", fake_subscriber, Serializer.JSON)
+
+    with patch("json.dumps", MagicMock(side_effect=json.dumps)) as json_dump:
+        broker.put_topic("/t6", 42)
+        assert json_dump.call_count == 1
+
+    frames = [s.sendmsg.call_args[0][0][0] for s in fake_subscribers]
+    assert all(frame is frames[0] for frame in frames)
+
+    for fake_subscriber in fake_subscribers:
+        broker.disconnect(fake_subscriber)
+
+
+def test_passthrough(broker):
+    publisher = fake_connection(broker)
+    broker.serializer_of_userDic[publisher] = Serializer.JSON
+    same, other = fake_connection(broker), fake_connection(broker)
+    broker.subscribe("/t7", same, Serializer.JSON)
+    broker.subscribe("/t7", other, Serializer.PICKLE)
+
+    data = json.dumps({"method": "PUBLISH", "topic": "/t7", "msg": [1, 2]}).encode("utf-8")
+    with patch.object(broker, "encode", MagicMock(side_effect=broker.encode)) as encode:
+        broker.handle(publisher, memoryview(data))
+        assert [call[0][0] for call in encode.call_args_list] == [Serializer.PICKLE]
+
+    assert bytes(same.sendmsg.call_args[0][0][0]) == len(data).to_bytes(3, "little") + data
+    assert broker.get_topic("/t7") == [1, 2]
+
+    for conn in (publisher, same, other):
+        broker.disconnect(conn)
+
+
+def test_outbound_buffer():
+    outbound = OutboundBuffer()
+    for frame in (b"a" * 10, b"b" * 10, b"c" * 10):
+        outbound.append(frame)
+
+    assert not outbound.flush(fake_connection(None, accept=15))  # partial write
+    assert outbound.size == 15 and outbound.sent == 5
+
+    outbound.drop_oldest(5)  # half-written frame is never dropped
+    assert list(outbound.frames) == [b"b" * 10]
+
+    conn = fake_connection(None)
+    assert outbound.flush(conn)
+    assert bytes(conn.sendmsg.call_args[0][0][0]) == b"b" * 5
+    assert outbound.size == 0
+
+
+def test_write_after_disconnect(broker):
+    conn = fake_connection(broker)
+    broker.disconnect(conn)
+
+    broker.write(conn, b"late")  # e.g. a later frame of the same fan-out
+    assert not conn.sendmsg.called
+    assert conn not in broker.outbound_of_userDic
+
+
+def test_lazy_payload(broker):
+    publisher = fake_connection(broker)
+    broker.serializer_of_userDic[publisher] = Serializer.JSON
+    same, other = fake_connection(broker), fake_connection(broker)
+    broker.subscribe("/t11", same, Serializer.JSON)
+    broker.offset_users.add(same)   # gets a re-encoded frame, with the offset
+    broker.subscribe("/t11", other, Serializer.XML)
+
+    data = json.dumps({"method": "PUBLISH", "topic": "/t11", "msg": {"a": [1, 2.5]}}).encode("utf-8")
+    method, topic, message = broker.decodeJSON(data)
+    assert (method, topic, message.raw) == ("PUBLISH", "/t11", b'{"a": [1, 2.5]}')
+    assert message._decode is not None  # not parsed yet
+
+    broker.handle(publisher, memoryview(data))
+    delivered = json.loads(bytes(same.sendmsg.call_args[0][0][0])[3:])
+    assert delivered["msg"] == {"a": [1, 2.5]} and "offset" in delivered
+    assert broker.get_topic("/t11") == {"a": [1, 2.5]}
+
+    xml_data = b'<?xml version="1.0"?><data method="PUBLISH" topic="/t11"><msg>1 &lt; 2</msg></data>'
+    assert broker.decodeXML(xml_data)[2].value == broker.decodeXML(xml_data.replace(b"<msg>", b"<msg >"))[2]
+
+    for conn in (publisher, same, other):
+        broker.disconnect(conn)
+
+
+def test_payload_trailing_keys(broker):
+    data = b'{"method": "PUBLISH", "topic": "/t", "msg": {"a": 1}, "id": "x"}'
+    assert broker.decodeJSON(data)[2].value == {"a": 1}
+    xml_data = b'<?xml version="1.0"?><data method="PUBLISH" topic="/t"><msg>1</msg><msg>2</msg></data>'
+    assert broker.decodeXML(xml_data)[2].value == "1"
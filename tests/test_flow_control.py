@@ -0,0 +1,112 @@
+"""Test pausing publishers and publish credits."""
+import json
+import selectors
+import socket
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from src.broker import Broker, Serializer
+from src.framing import FrameBuffer
+from src.middleware import JSONQueue, MiddlewareType
+from tests.helpers import TOPIC, fake_connection, frame
+
+
+def test_flow_control():
+    flow = Broker(port=0, pause_threshold=64 * 1024)
+
+    def accept(serializer="JSONQueue"):
+        conn, peer = socket.socketpair()
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        peer.sendall(frame(json.dumps({"method": "ACK", "Serializer": serializer}).encode()))
+        flow.accept(MagicMock(accept=lambda: (conn, "local")), 0)
+        return conn, peer
+
+    subscriber, subscriber_peer = accept()
+    subscriber_peer.sendall(frame(json.dumps({"method": "SUBSCRIBE", "topic": "/f", "msg": "/f"}).encode()))
+    flow.read(subscriber, 0)
+    producer, producer_peer = accept()
+    producer_peer.sendall(frame(json.dumps({"method": "CREDIT", "topic": "", "msg": ""}).encode()))
+    for _ in range(8):
+        producer_peer.sendall(frame(json.dumps({"method": "PUBLISH", "topic": "/f", "msg": "x" * 16384}).encode()))
+    while producer not in flow.paused and flow.offset < 8:
+        flow.read(producer, 0)
+
+    assert subscriber in flow.congested  # its peer reads nothing
+    assert producer in flow.paused
+    with pytest.raises(KeyError):
+        flow.selector.get_key(producer)  # no longer read from
+    assert flow.credits_of_userDic[producer] < flow.credits  # no grant while paused
+
+    subscriber_peer.setblocking(False)
+    while subscriber in flow.congested:
+        try:
+            subscriber_peer.recv(1 << 20)
+        except BlockingIOError:
+            pass
+        flow.flush(subscriber)
+    flow.resume_producers()
+    assert flow.selector.get_key(producer).events & selectors.EVENT_READ
+    assert flow.get_topic("/f") == "x" * 16384
+
+    producer_peer.settimeout(5)
+    replies = FrameBuffer()
+    replies.recv_from(producer_peer)
+    grant = json.loads(bytes(next(replies.frames())))
+    assert (grant["method"], grant["msg"]) == ("CREDIT", flow.credits)
+    flow.socket.close()
+
+
+def test_credits(broker):
+    topic = "/" + TOPIC + "/credits"
+    consumer = JSONQueue(topic, prefetch=1000)
+    producer = JSONQueue(topic, MiddlewareType.PRODUCER, flow_control=True)
+
+    for value in range(600):  # more than one grant of credits
+        producer.push(value)
+    assert 0 < producer.credit <= broker.credits
+
+    received = []
+    while len(received) < 600:
+        received += [value for _, value in consumer.pull_many(600, timeout=5)]
+    assert received == list(range(600))
+
+
+def test_congested_group_member(broker):
+    member, producer = fake_connection(broker), fake_connection(broker)
+    broker.subscribe("/t13", member, Serializer.JSON, group="g")
+    broker.put_topic("/t13", 0)
+
+    broker.congested.add(member)
+    broker.published(producer, "/t13", 1)
+    assert producer in broker.paused
+
+    broker.disconnect(producer)
+    broker.disconnect(member)
+    assert member not in broker.congested
+
+
+def test_local_out_of_credit(broker):
+    producer = JSONQueue("/" + TOPIC + "/local_credits", MiddlewareType.PRODUCER,
+                         broker=broker, flow_control=True, block=False)
+    producer.push(0)
+    producer.credit = 0  # as if spent, with no grant on the way
+
+    with pytest.raises(BlockingIOError):
+        producer.push(1)
+
+
+def test_local_credits_refilled(broker):
+    topic = "/" + TOPIC + "/local_refill"
+    producer = JSONQueue(topic, MiddlewareType.PRODUCER, broker=broker, flow_control=True)
+    pushing = threading.Thread(target=lambda: [producer.push(value) for value in range(broker.credits * 2 + 88)],
+                               daemon=True)
+    pushing.start()
+    pushing.join(timeout=5)
+    assert not pushing.is_alive()   # credits kept coming past the first grant
+    deadline = time.monotonic() + 5
+    while broker.get_topic(topic) != broker.credits * 2 + 87 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert broker.get_topic(topic) == broker.credits * 2 + 87
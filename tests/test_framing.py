@@ -0,0 +1,32 @@
+"""Test incremental decoding of frames."""
+import socket
+
+from src.framing import FrameBuffer
+from tests.helpers import frame
+
+
+def test_coalesced_frames():
+    reader, writer = socket.socketpair()
+    inbound = FrameBuffer()
+
+    writer.sendall(b"".join(frame(b"msg%d" % i) for i in range(100)))
+    assert inbound.recv_from(reader) > 0
+
+    assert [bytes(data) for data in inbound.frames()] == [b"msg%d" % i for i in range(100)]
+
+
+def test_partial_frames():
+    reader, writer = socket.socketpair()
+    inbound = FrameBuffer(size=16)
+    payload = bytes(range(256)) * 100  # larger than the buffer
+
+    data = frame(payload) + frame(b"tail")
+    for i in range(0, len(data), 1000):
+        writer.sendall(data[i:i + 1000])
+        inbound.recv_from(reader)
+        if i + 1000 < len(data) - 7:
+            assert inbound.next_frame() is None
+
+    assert bytes(inbound.next_frame()) == payload
+    assert bytes(inbound.next_frame()) == b"tail"
+    assert inbound.next_frame() is None
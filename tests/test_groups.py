@@ -0,0 +1,95 @@
+"""Test consumer groups sharing the messages of a topic."""
+import json
+
+from src.broker import Broker, Overflow, Serializer
+from src.clients import Consumer
+from src.middleware import JSONQueue, MiddlewareType
+from tests.helpers import TOPIC, fake_connection
+
+
+def test_consumer_groups(broker):
+    members = [fake_connection(broker) for _ in range(3)]
+    plain = fake_connection(broker)
+    for member in members:
+        broker.subscribe("/t8", member, Serializer.JSON, group="workers")
+    broker.subscribe("/t8", plain, Serializer.JSON)
+
+    for value in range(6):
+        broker.put_topic("/t8/reading", value)
+    assert [m.sendmsg.call_count for m in members] == [2, 2, 2]  # round-robin
+    assert plain.sendmsg.call_count == 6
+
+    broker.unsubscribe("/t8", members[0])
+    broker.forget(members[1])
+    broker.put_topic("/t8/reading", 6)
+    assert [m.sendmsg.call_count for m in members] == [2, 2, 3]
+
+    for conn in members + [plain]:
+        broker.disconnect(conn)
+    assert broker.topics.find("/t8") is None
+
+
+def test_least_outstanding(broker):
+    busy, idle = fake_connection(broker), fake_connection(broker)
+    broker.subscribe("/t9", busy, Serializer.JSON, group="g", balance="least_outstanding")
+    broker.subscribe("/t9", idle, Serializer.JSON, group="g")
+    broker.outbound_of_userDic[busy].append(b"pending")  # not yet written
+
+    for value in range(3):
+        broker.put_topic("/t9", value)
+    assert idle.sendmsg.call_count == 3
+    assert busy.sendmsg.call_count == 0
+
+    broker.disconnect(busy)
+    broker.disconnect(idle)
+
+
+def test_consumer_group(broker):
+    topic = "/" + TOPIC + "/group"
+    members = [Consumer(topic, JSONQueue, group="workers") for _ in range(2)]
+    listener = Consumer(topic, JSONQueue)
+    JSONQueue(topic, MiddlewareType.PRODUCER).push_many(range(4))
+
+    for member in members:
+        member.run(2)
+    listener.run(4)
+    assert sorted(members[0].received + members[1].received) == listener.received == list(range(4))
+
+
+def test_hand_over(broker):
+    members = [fake_connection(broker) for _ in range(3)]
+    for member in members:
+        broker.serializer_of_userDic[member] = Serializer.JSON
+        broker.handle(member, json.dumps(
+            {"method": "SUBSCRIBE", "topic": "/t12", "msg": {"group": "g", "window": 10}}).encode())
+
+    def delivered(member):
+        return [json.loads(bytes(call[0][0][0])[3:])["msg"] for call in member.sendmsg.call_args_list]
+
+    for value in range(3):
+        broker.put_topic("/t12", value)
+    assert [delivered(member) for member in members] == [[0], [1], [2]]
+
+    broker.dispatch(members[0], "CANCEL", "/t12", None)  # left without acknowledging 0
+    broker.disconnect(members[1])                       # died without acknowledging 1
+    assert delivered(members[0]) == [0]
+    assert sorted(delivered(members[2])) == [0, 1, 2]
+    inflight = broker.inflight_of_userDic[members[2]]
+    assert len(inflight) == 3
+    offsets = sorted(inflight.messages)
+    assert inflight.ack_upto(offsets[1]) == 2 and list(inflight.messages) == offsets[2:]
+    assert not broker.inflight_of_userDic[members[0]]
+
+    broker.disconnect(members[0])
+    broker.disconnect(members[2])
+
+
+def test_group_emptied_during_fan_out():
+    strict = Broker(port=0, high_water_mark=16, overflow=Overflow.DISCONNECT)
+    member = fake_connection(strict, accept=0)
+    strict.subscribe("/a", member, Serializer.JSON)
+    strict.subscribe("/a/b", member, Serializer.JSON, group="g")
+    strict.outbound_of_userDic[member].append(b"x" * 16)   # at the high-water mark
+    strict.put_topic("/a/b", 1)    # the plain subscription disconnects it before its group
+    assert member not in strict.outbound_of_userDic
+    strict.socket.close()
@@ -0,0 +1,29 @@
+"""Test the broker metrics and the STATS request."""
+from src.metrics import Histogram
+from src.middleware import JSONQueue, MiddlewareType
+from tests.helpers import TOPIC
+
+
+def test_histogram():
+    histogram = Histogram()
+    for microseconds in [1, 2, 3, 100, 5000]:
+        histogram.record(microseconds / 1e6)
+
+    assert histogram.count == 5
+    assert histogram.quantile(0.5) == 4e-6  # 3us falls in the [2, 4) bucket
+    assert histogram.quantile(0.99) == 8192e-6
+
+
+def test_stats(broker):
+    queue = JSONQueue("/" + TOPIC + "/stats", MiddlewareType.PRODUCER)
+    queue.push(1)
+
+    stats = queue.request_stats()
+    assert stats["frames_in"]["PUBLISH"] >= 1
+    assert stats["decode"]["JSON"]["count"] >= 1
+    assert stats["connections"] >= 1
+    assert stats["topics"] == len(broker.list_topics())
+
+    text = queue.request_stats(text=True)
+    assert 'broker_frames_in{method="PUBLISH"}' in text
+    assert "broker_loop_count" in text
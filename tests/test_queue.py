@@ -0,0 +1,145 @@
+"""Test the Queue features clients use to send and receive."""
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from src.broker import Broker
+from src.clients import Consumer, Producer
+from src.middleware import BinaryQueue, JSONQueue, MiddlewareType, PickleQueue, XMLQueue
+from tests.helpers import TOPIC
+
+
+@pytest.mark.parametrize("queue_type", [JSONQueue, XMLQueue, PickleQueue, BinaryQueue])
+def test_batch(broker, queue_type):
+    topic = "/" + TOPIC + "/batch/" + queue_type.__name__
+    consumer = Consumer(topic, JSONQueue)
+    queue = queue_type(topic, MiddlewareType.PRODUCER)
+
+    with patch.object(queue, "encode", MagicMock(side_effect=queue.encode)) as encode:
+        queue.push_many(range(10))
+        assert encode.call_count == 1  # a single frame
+
+    consumer.run(10)
+    assert [int(value) for value in consumer.received] == list(range(10))
+
+
+def test_auto_batch(broker):
+    topic = "/" + TOPIC + "/linger"
+    consumer = Consumer(topic, JSONQueue)
+    queue = JSONQueue(topic, MiddlewareType.PRODUCER, linger=0.05, max_batch=4)
+
+    with patch.object(queue, "push_many", MagicMock(side_effect=queue.push_many)) as push_many:
+        for value in range(6):
+            queue.push(value)
+        assert push_many.call_args_list[0][0][0] == [0, 1, 2, 3]
+
+        consumer.run(6)
+        assert push_many.call_args_list[1][0][0] == [4, 5]  # sent once linger passed
+
+    assert consumer.received == list(range(6))
+
+
+def test_prefetch(broker):
+    topic = "/" + TOPIC + "/prefetch"
+    queue = JSONQueue(topic, prefetch=16)
+    producer = JSONQueue(topic, MiddlewareType.PRODUCER)
+    producer.push_many(range(5))
+
+    received = []
+    while len(received) < 5:
+        batch = queue.pull_many(5, timeout=5)
+        assert batch  # nothing arrived in time
+        received += batch
+    assert received == [(topic, value) for value in range(5)]
+    assert queue.pull_many(5, timeout=0.01) == []
+
+    producer.push(5)
+    assert queue.pull() == (topic, 5)
+
+
+def test_on_message(broker):
+    topic = "/" + TOPIC + "/callback"
+    queue = JSONQueue(topic)
+    received, done = [], threading.Event()
+
+    def callback(topic, data):
+        received.append(data)
+        if len(received) == 3:
+            done.set()
+
+    queue.on_message(callback)
+    JSONQueue(topic, MiddlewareType.PRODUCER).push_many(["a", "b", "c"])
+    assert done.wait(5)
+    assert received == ["a", "b", "c"]
+
+
+def test_multiplexing(broker):
+    topics = ["/" + TOPIC + "/mux/" + str(n) for n in range(3)]
+    queue = JSONQueue(topics[0])
+    for topic in topics[1:]:
+        queue.subscribe(topic)
+
+    producer = Producer(topics, lambda: iter([1, 2, 3]), JSONQueue)
+    assert isinstance(producer.queue, JSONQueue)  # one connection for every topic
+    producer.run(1)
+
+    assert sorted(queue.pull() for _ in topics) == list(zip(topics, [1, 2, 3]))
+    assert [broker.get_topic(topic) for topic in topics] == [1, 2, 3]
+
+
+def test_in_process(broker):
+    topic = "/" + TOPIC + "/local"
+    local_consumer = Consumer(topic, JSONQueue, broker=broker)
+    tcp_consumer = Consumer(topic, JSONQueue)
+    subtopic_consumer = Consumer("/" + TOPIC, JSONQueue, broker=broker, intern_topics=True)
+    producer = Producer(topic, lambda: iter([{"celsius": 21}]), JSONQueue, broker=broker)
+
+    with patch.object(producer.queue, "encode") as encode:
+        producer.run(2)
+        assert not encode.called  # never serialized
+
+    local_consumer.run(2)
+    assert local_consumer.received == producer.produced
+    assert local_consumer.received[0] is producer.produced[0]  # handed over as is
+    tcp_consumer.run(2)
+    assert tcp_consumer.received == producer.produced
+    assert subtopic_consumer.queue.pull() == (topic, {"celsius": 21})
+    assert broker.get_topic(topic) == {"celsius": 21}
+
+
+def test_close(broker):
+    topic = "/" + TOPIC + "/close"
+    consumers = [JSONQueue(topic, broker=broker), JSONQueue(topic)]
+    JSONQueue(topic, MiddlewareType.PRODUCER, broker=broker).push(1)
+    assert [consumer.pull() for consumer in consumers] == [(topic, 1)] * 2
+
+    for consumer in consumers:
+        consumer.close()
+    deadline = time.monotonic() + 5
+    while broker.topics.find(topic) is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert broker.topics.find(topic) is None  # both subscriptions dropped
+    assert consumers[0].local not in broker.topics_of_userDic
+
+
+@pytest.mark.parametrize("transport", ["unix", "tcp"])
+def test_transport_options(tmp_path, transport):
+    if transport == "unix":
+        address = {"unix_path": str(tmp_path / "broker.sock")}
+        local_broker = Broker(**address)
+    else:
+        local_broker = Broker(port=0, backlog=8, sndbuf=1 << 16, rcvbuf=1 << 16)
+        address = {"port": local_broker.socket.getsockname()[1]}
+    thread = threading.Thread(target=local_broker.run, daemon=True)
+    thread.start()
+
+    try:
+        consumer = JSONQueue("/transport", **address)
+        producer = JSONQueue("/transport", MiddlewareType.PRODUCER, sndbuf=1 << 16, **address)
+        producer.push(7)
+        assert consumer.pull() == ("/transport", 7)
+    finally:
+        local_broker.canceled = True
+        thread.join(timeout=5)
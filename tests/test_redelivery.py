@@ -0,0 +1,56 @@
+"""Test acknowledged delivery and redelivery."""
+import json
+
+from src.acks import InFlight
+from src.broker import Serializer
+from src.middleware import JSONQueue, MiddlewareType
+from tests.helpers import TOPIC, fake_connection
+
+
+def test_acknowledgements(broker):
+    subscriber = fake_connection(broker)
+    broker.serializer_of_userDic[subscriber] = Serializer.JSON
+    broker.handle(subscriber, json.dumps({"method": "SUBSCRIBE", "topic": "/t10", "msg": {"window": 2}}).encode())
+
+    def delivered():
+        return [json.loads(bytes(call[0][0][0])[3:])["msg"] for call in subscriber.sendmsg.call_args_list]
+
+    for value in range(4):
+        broker.put_topic("/t10", value)
+    assert delivered() == [0, 1]  # window full
+    offsets = list(broker.inflight_of_userDic[subscriber].messages)
+
+    broker.acknowledge(subscriber, offsets[0])
+    assert delivered() == [0, 1, 2]
+
+    for entry in broker.inflight_of_userDic[subscriber].messages.values():
+        entry[0] = 0  # overdue
+    broker.redeliver()
+    assert delivered() == [0, 1, 2, 1, 2]  # 1 and 2 were never acknowledged
+
+    broker.acknowledge(subscriber, {"upto": offsets[1] + 2})
+    assert delivered() == [0, 1, 2, 1, 2, 3]
+    assert len(broker.inflight_of_userDic[subscriber]) == 1
+
+    broker.disconnect(subscriber)
+    assert subscriber not in broker.inflight_of_userDic
+
+
+def test_ack(broker):
+    topic = "/" + TOPIC + "/ack"
+    consumer = JSONQueue(topic, window=1)
+    producer = JSONQueue(topic, MiddlewareType.PRODUCER)
+    producer.push_many(range(3))
+
+    for value in range(3):
+        assert consumer.pull() == (topic, value)
+        consumer.ack()  # the next value is only sent once this one is acknowledged
+
+
+def test_inflight_order():
+    inflight = InFlight(window=5)
+    for offset in (1, 3, 5, 0, 2, 6, 4):    # 0, 2 and 4 handed over late
+        inflight.admit(offset, "/t", offset, deadline=0)
+    assert inflight.ack_upto(3) == 4 and list(inflight.messages) == [5]
+    assert [offset for offset, _, _ in inflight.release(deadline=0)] == [4, 6]
+    assert list(inflight.messages) == [4, 5, 6]
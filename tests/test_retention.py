@@ -0,0 +1,87 @@
+"""Test the per-topic retention log and replaying it to subscribers."""
+import json
+import threading
+import time
+
+import pytest
+
+from src.broker import Broker
+from src.framing import FrameBuffer
+from src.middleware import MiddlewareType, XMLQueue
+from src.payload import materialize
+from src.retention import RetentionLog
+from tests.helpers import connect, request
+
+
+def test_evicts_by_count():
+    log = RetentionLog(3, 1 << 20)
+    for offset in range(5):
+        log.append(offset, offset * 10, 1)
+
+    assert log.last(10) == [(2, 20), (3, 30), (4, 40)]
+    assert log.last(1) == [(4, 40)]
+    assert log.since(3) == [(3, 30), (4, 40)]
+    assert log.since(0) == log.last(3)
+
+
+def test_evicts_by_bytes():
+    log = RetentionLog(10, 10)
+    log.append(0, "aaaa", 4)
+    log.append(1, "bbbb", 4)
+    log.append(2, "cccc", 4)
+    assert log.last(10) == [(1, "bbbb"), (2, "cccc")]
+
+    log.append(3, "x" * 20, 20)  # too big on its own, but still kept
+    assert log.last(10) == [(3, "x" * 20)]
+    assert log.size == 20
+
+
+@pytest.fixture
+def retaining_broker():
+    broker = Broker(port=0, retention=4)
+    thread = threading.Thread(target=broker.run, daemon=True)
+    thread.start()
+    yield broker
+    broker.canceled = True
+    thread.join(timeout=5)
+
+
+def test_replay(retaining_broker):
+    address = retaining_broker.socket.getsockname()
+
+    def receive(conn, count):
+        inbound, received = FrameBuffer(), []
+        while len(received) < count:
+            inbound.recv_from(conn)
+            for data in inbound.frames():
+                message = json.loads(bytes(data))
+                received.append((message["offset"], message["msg"]))
+        return received
+
+    producer = connect(address)
+    for value in range(6):
+        request(producer, "PUBLISH", "/r", value)
+    time.sleep(0.1)
+
+    retained = [(offset, materialize(value))    # kept as published
+                for offset, value in retaining_broker.retention_of_topicDic["/r"].last(10)]
+    assert [value for _, value in retained] == [2, 3, 4, 5]
+
+    last = connect(address)
+    request(last, "SUBSCRIBE", "/r", {"last": 2})
+    assert [value for _, value in receive(last, 2)] == [4, 5]
+
+    since = connect(address)
+    request(since, "SUBSCRIBE", "/r", {"offset": retained[1][0]})
+    assert receive(since, 3) == retained[1:]
+
+
+def test_xml_subscribe_options(broker):
+    queue = XMLQueue("/xml", MiddlewareType.PRODUCER)
+
+    options = {"last": 2, "note": 'say "hi" & <bye>'}
+    assert broker.decodeXML(queue.encode("SUBSCRIBE", "/xml", options)) == (
+        "SUBSCRIBE", "/xml", {"last": "2", "note": 'say "hi" & <bye>'})
+
+    _, _, value = broker.decodeXML(queue.encode("PUBLISH", "/xml", {"celsius": 21}))
+    assert materialize(value) == "{'celsius': 21}"  # a value, sent as text
@@ -0,0 +1,51 @@
+"""Test the memory-mapped segment store."""
+from unittest.mock import MagicMock, patch
+
+from src import binary
+from src.broker import Broker, Serializer
+from src.store import SegmentStore
+
+
+def test_segments(tmp_path):
+    store = SegmentStore(str(tmp_path), segment_bytes=256, index_interval=4)
+    for offset in range(40):
+        assert store.append("/even" if offset % 2 == 0 else "/odd", offset, "value %d" % offset)
+    assert not store.append("/odd", 40, object())
+    store.sync()
+    assert len(store.segments) > 1
+
+    reopened = SegmentStore(str(tmp_path), segment_bytes=256, index_interval=4)
+    assert reopened.topics() == ["/even", "/odd"]
+    assert reopened.next_offset == 40
+    assert reopened.last("/odd") == (39, "value 39")
+
+    replayed = [(offset, binary.decode(frame[3:])) for offset, frame in reopened.since("/even", 21)]
+    assert [offset for offset, _ in replayed] == list(range(22, 40, 2))
+    assert replayed[0][1] == ("LAST_POST", "/even", "value 22", 22)
+
+    reopened.append("/even", 40, "value 40")
+    assert [offset for offset, _ in reopened.since("/even", 38)] == [38, 40]
+
+
+def test_restore(tmp_path):
+    broker = Broker(port=0, data_dir=str(tmp_path))
+    for value in range(5):
+        broker.put_topic("/kept", value)
+    broker.put_topic("/other", "x")
+    broker.store.sync()
+    broker.socket.close()
+
+    restarted = Broker(port=0, data_dir=str(tmp_path))
+    restarted.socket.close()
+    assert restarted.list_topics() == ["/kept", "/other"]
+    assert restarted.get_topic("/kept") == 4
+    assert restarted.offset == 6
+
+    conn = MagicMock()
+    restarted.serializer_of_userDic[conn] = Serializer.BINARY
+    with patch.object(restarted, "write") as write:
+        restarted.replay(conn, "/kept", {"offset": 2})
+
+    frames = [call[0][1] for call in write.call_args_list]
+    assert all(isinstance(frame, memoryview) for frame in frames)  # straight from the mapping
+    assert [binary.decode(frame[3:])[2] for frame in frames] == [2, 3, 4]
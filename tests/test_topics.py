@@ -0,0 +1,67 @@
+"""Test matching published topics to subscriptions."""
+from unittest.mock import MagicMock
+
+import pytest
+
+from src.broker import Serializer
+
+
+def test_subtopic_matching(broker):
+    fake_subscriber = MagicMock()
+
+    broker.subscribe("/temp", fake_subscriber, Serializer.JSON)
+
+    assert [node.subscribers for node in broker.topics.matches("/temp/celsius")] == [
+        [(fake_subscriber, Serializer.JSON)]
+    ]
+    assert list(broker.topics.matches("/temperature")) == []  # no substring match
+
+    broker.unsubscribe("/temp", fake_subscriber)
+    assert broker.list_subscriptions("/temp") == []
+
+
+def test_wildcards(broker):
+    single, multi, celsius = MagicMock(), MagicMock(), MagicMock()
+    broker.subscribe("/weather2/+/humidity", single, Serializer.JSON)
+    broker.subscribe("/weather2/#", multi, Serializer.JSON)
+    broker.subscribe("/+/+/celsius", celsius, Serializer.JSON)
+
+    def targets(topic):
+        return {address for address, _ in broker.resolve_targets(topic)}
+
+    assert targets("/weather2/porto/humidity") == {single, multi}
+    assert targets("/weather2/porto/celsius") == {multi, celsius}
+    assert targets("/weather2") == {multi}
+    assert targets("/weather/lisbon/celsius") == {celsius}
+    assert targets("/weather2/porto/wind") == {multi}
+    assert targets("/weather") == set()
+
+    with pytest.raises(ValueError):
+        broker.subscribe("/#/celsius", single, Serializer.JSON)
+
+    broker.unsubscribe("/weather2/+/humidity", single)
+    broker.unsubscribe("/weather2/#", multi)
+    broker.unsubscribe("/+/+/celsius", celsius)
+    assert broker.topics.find("/weather2") is None
+    assert broker.topics.find("/+") is None
+
+
+def test_delivery_list(broker):
+    fake_subscriber1 = MagicMock()
+    fake_subscriber2 = MagicMock()
+
+    broker.subscribe("/t5", fake_subscriber1, Serializer.JSON)
+    broker.subscribe("/t5/a", fake_subscriber1, Serializer.JSON)
+    broker.subscribe("/t5/a", fake_subscriber2, Serializer.XML)
+
+    assert broker.resolve_targets("/t5/a") == [
+        (fake_subscriber1, Serializer.JSON),
+        (fake_subscriber2, Serializer.XML),
+    ]
+
+    broker.targets_of_topicDic["/t5/a"] = broker.resolve_targets("/t5/a")
+    broker.unsubscribe("/t5/a", fake_subscriber2)
+    assert "/t5/a" not in broker.targets_of_topicDic
+
+    broker.unsubscribe("/t5", fake_subscriber1)
+    broker.unsubscribe("/t5/a", fake_subscriber1)
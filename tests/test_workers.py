@@ -0,0 +1,58 @@
+"""Test replication between the workers of a multi-process broker."""
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+from src.broker import Broker
+from src.framing import FrameBuffer
+from tests.helpers import connect, request
+
+
+@pytest.fixture
+def workers():
+    brokers = [Broker(port=0, worker_id=worker_id) for worker_id in range(2)]
+    link = socket.socketpair()
+    for broker, sock in zip(brokers, link):
+        broker.add_peer(sock)
+
+    threads = [threading.Thread(target=broker.run, daemon=True) for broker in brokers]
+    for thread in threads:
+        thread.start()
+    yield brokers
+    for broker in brokers:
+        broker.canceled = True
+    for thread in threads:
+        thread.join(timeout=5)
+
+
+def test_forward_between_workers(workers):
+    worker_a, worker_b = workers
+
+    consumer = connect(worker_b.socket.getsockname())
+    request(consumer, "SUBSCRIBE", "/w", "/w")
+    producer = connect(worker_a.socket.getsockname())
+    time.sleep(0.1)
+    request(producer, "PUBLISH", "/w/x", 1)
+    request(producer, "PUBLISH", "/w/y", 2)
+
+    inbound, received = FrameBuffer(), []
+    while len(received) < 2:
+        inbound.recv_from(consumer)
+        received += [json.loads(bytes(data))["msg"] for data in inbound.frames()]
+    assert received == [1, 2]
+
+    assert worker_a.list_topics() == worker_b.list_topics() == ["/w/x", "/w/y"]
+    assert worker_b.get_topic("/w/y") == 2
+
+
+def test_last_value_converges(workers):
+    worker_a, worker_b = workers
+
+    worker_a.put_topic("/v", "old", (1, 0))
+    worker_a.put_topic("/v", "new", (2, 1))
+    worker_a.put_topic("/v", "late", (2, 0))  # older version arriving last
+
+    assert worker_a.get_topic("/v") == "new"